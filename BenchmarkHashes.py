@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from HashUtil import HashList
+from HashUtil import Extensions
+
+def GetImages(path):
+    for r, d, p in os.walk(path):
+        for fi in p:
+            ext = fi.split(".")[-1].lower().encode()
+            if ext in HashList.PIL_supportedImageTypes:
+                yield os.path.join(r, fi), ext
+
+def TimePerceptual(hashlist, path, ext):
+    """Perceptual hash of one file and the seconds it took, decode included"""
+    with open(path, "rb") as f:
+        decoded = HashList.CDecodedImage(f)
+
+        start = time.perf_counter()
+        ph = hashlist._PerceptualHash(f, os.path.getsize(path), path.encode(), ext, False, decoded=decoded)
+        elapsed = time.perf_counter() - start
+
+        decoded.Close()
+
+    return ph, elapsed
+
+def BenchmarkPerceptual(path):
+    full = HashList.CHashList(None, [Extensions.EXT_PerceptualHash], inMemory=True)
+    reduced = HashList.CHashList(None, [Extensions.EXT_PerceptualHash, Extensions.EXT_ReducedPerceptualDecode], inMemory=True)
+
+    fullTime = 0
+    reducedTime = 0
+    worst = 0
+    worstPath = None
+    count = 0
+
+    for imagePath, ext in GetImages(path):
+        fullPh, fullElapsed = TimePerceptual(full, imagePath, ext)
+        reducedPh, reducedElapsed = TimePerceptual(reduced, imagePath, ext)
+
+        if fullPh is None or reducedPh is None:
+            continue
+
+        distance = full.perceptualHasher.compute_distance(fullPh[0], reducedPh[0])
+        print("[INFO] {} ({}x{}): {:.1f}ms -> {:.1f}ms, drift {:.3f}".format(imagePath, fullPh[1], fullPh[2], fullElapsed * 1000, reducedElapsed * 1000, distance))
+
+        fullTime += fullElapsed
+        reducedTime += reducedElapsed
+        count += 1
+
+        if distance >= worst:
+            worst = distance
+            worstPath = imagePath
+
+    if count == 0:
+        print("[WARN] No images found below {}".format(path))
+        return
+
+    print("[RESULT] {} images: full {:.2f}s, reduced {:.2f}s ({:.1f}x)".format(count, fullTime, reducedTime, fullTime / max(reducedTime, 1e-9)))
+    print("[RESULT] Largest drift {:.3f} ({}), threshold {}: {}".format(worst, worstPath, HashList.GLOBAL_LOG_THRESHOLD, "OK" if worst < HashList.GLOBAL_LOG_THRESHOLD else "TOO LARGE"))
+
+# Name and the capabilities that select each provider
+PROVIDERS = [
+    ("SHA3_256", []),
+    ("SHA512_256", [Extensions.EXT_SHA512]),
+    ("BLAKE2b", [Extensions.EXT_BLAKE2b]),
+    ("BLAKE2s", [Extensions.EXT_BLAKE2s]),
+]
+
+def HashBuffer(hashlist, buffer, rounds):
+    view = memoryview(buffer)
+    for _ in range(rounds):
+        digest = hashlist._NewDigest()
+        digest.update(view)
+        digest.finalize()
+
+def TimeProvider(hashlist, buffer, rounds, jobs):
+    """GB/s over all threads, each hashing the buffer rounds times"""
+    start = time.perf_counter()
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for future in [pool.submit(HashBuffer, hashlist, buffer, rounds) for _ in range(jobs)]:
+                future.result()
+    else:
+        HashBuffer(hashlist, buffer, rounds)
+
+    elapsed = time.perf_counter() - start
+    return len(buffer) * rounds * jobs / elapsed / 1e9
+
+def BenchmarkProviders(sizeMiB, rounds, jobs):
+    buffer = os.urandom(sizeMiB * 1024 * 1024)
+
+    for name, capabilities in PROVIDERS:
+        hashlist = HashList.CHashList(None, capabilities, inMemory=True)
+
+        single = TimeProvider(hashlist, buffer, rounds, 1)
+        line = "[RESULT] {:<10} {:.2f} GB/s per core".format(name, single)
+
+        if jobs > 1:
+            threaded = TimeProvider(hashlist, buffer, rounds, jobs)
+            line += ", {:.2f} GB/s on {} threads ({:.1f}x)".format(threaded, jobs, threaded / single)
+
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Times the ways this package hashes files")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    perceptualParser = modes.add_parser("perceptual", help="Full against reduced decoding for the perceptual hash of the images below a directory")
+    perceptualParser.add_argument("path", metavar="path", type=str)
+
+    providersParser = modes.add_parser("providers", help="Throughput of each hash provider")
+    providersParser.add_argument("--size", type=int, default=64, help="MiB hashed per round")
+    providersParser.add_argument("--rounds", type=int, default=8, help="Rounds per thread")
+    providersParser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Threads for the threaded run. 1 skips it")
+
+    args = parser.parse_args()
+
+    if args.mode == "perceptual":
+        if not os.path.exists(args.path):
+            raise IOError("Directory \"{}\" does not exist".format(args.path))
+
+        BenchmarkPerceptual(args.path)
+    else:
+        BenchmarkProviders(args.size, args.rounds, args.jobs)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+from HashUtil import Chunking
+from HashUtil import Walker
+
+excludeDirs = [".git"]
+
+def WalkFiles(path):
+    for r, fi, relp, ext, stat in Walker.Walk(path, excludeDirs):
+        if fi is not None:
+            yield os.path.join(r, fi)
+
+def FormatBytes(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit)
+        size /= 1024
+    return "{:.1f}TiB".format(size)
+
+def ChunkTree(path, averageSize):
+    chunker = Chunking.CChunker(averageSize)
+    index = Chunking.CChunkIndex()
+
+    for filePath in WalkFiles(path):
+        try:
+            with open(filePath, "rb") as f:
+                keys, sizes = chunker.ChunkFile(f)
+        except OSError as e:
+            print("Error on file {}: {}".format(filePath, e), file=sys.stderr)
+            continue
+
+        index.Add(os.path.relpath(filePath, path), keys, sizes)
+
+    return index
+
+def PrintShared(index, minShared, maxHolders):
+    """Pairs sharing at least minShared of the smaller file, most shared first"""
+    shared, common = index.SharedBytes(maxHolders)
+
+    if common:
+        print("[WARN] {} chunks are in more than {} files each, and weren't counted towards what pairs share".format(common, maxHolders))
+
+    rows = []
+    for (a, b), size in shared.items():
+        ratio = size / max(min(index.FileBytes(a), index.FileBytes(b)), 1)
+        if ratio >= minShared:
+            rows.append((size, a, b))
+
+    for size, a, b in sorted(rows, reverse=True):
+        print("[SHARED] {} ~ {}: {} ({:.1%} of the first, {:.1%} of the second)".format(index.names[a], index.names[b], FormatBytes(size), size / max(index.FileBytes(a), 1), size / max(index.FileBytes(b), 1)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Estimates how much block level deduplication would save, by content defined chunking")
+    parser.add_argument('--average', type=int, default=Chunking.DEFAULT_AVERAGE_SIZE // 1024, help='Average chunk size in KiB')
+    parser.add_argument('--min-shared', type=float, default=0.1, help='Smallest fraction of the smaller file two files must share to be listed')
+    parser.add_argument('--max-holders', type=int, default=Chunking.DEFAULT_MAX_HOLDERS, help='Chunks in more files than this are left out of what pairs share. Pairs grow with its square')
+    parser.add_argument("path", metavar="path", type=str)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        raise IOError("Directory \"{}\" does not exist".format(args.path))
+
+    index = ChunkTree(args.path, args.average * 1024)
+    PrintShared(index, args.min_shared, args.max_holders)
+
+    total = index.TotalBytes()
+    unique = index.UniqueBytes()
+    print("[RESULT] {} files, {} in total, {} in unique chunks. Block level deduplication would save {} ({:.1%})".format(len(index), FormatBytes(total), FormatBytes(unique), FormatBytes(total - unique), (total - unique) / max(total, 1)))
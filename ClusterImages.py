@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import multiprocessing
+import numpy
+from HashUtil import HashList
+from HashUtil import HashStore
+
+# Set in each worker, so tiles don't have to carry the matrix with them
+tileBits = None
+
+def InitWorker(bits):
+    global tileBits
+    tileBits = bits
+
+def MatchTile(tile):
+    """Pairs (i, j), i < j, within radius bits of each other in one tile of the distance matrix"""
+    i0, i1, j0, j1, radius = tile
+
+    distances = HashStore.HammingDistances(tileBits[i0:i1], tileBits[j0:j1])
+    ii, jj = numpy.nonzero(distances <= radius)
+    ii += i0
+    jj += j0
+
+    # Tiles on the diagonal see every pair twice, and each image against itself
+    upper = ii < jj
+    return ii[upper], jj[upper], distances[ii[upper] - i0, jj[upper] - j0]
+
+def GetTiles(count, tileSize, radius):
+    for i0 in range(0, count, tileSize):
+        for j0 in range(i0, count, tileSize):
+            yield (i0, min(i0 + tileSize, count), j0, min(j0 + tileSize, count), radius)
+
+def FindRoot(parents, x):
+    while parents[x] != x:
+        parents[x] = parents[parents[x]]
+        x = parents[x]
+    return x
+
+def ClusterBits(bits, radius, tileSize, jobs):
+    """Group images joined by any chain of pairs within radius bits. Returns lists of indices into bits"""
+    parents = list(range(len(bits)))
+    tiles = GetTiles(len(bits), tileSize, radius)
+
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=InitWorker, initargs=(bits,)) as pool:
+            results = pool.imap_unordered(MatchTile, tiles)
+            for ii, jj, _ in results:
+                for i, j in zip(ii.tolist(), jj.tolist()):
+                    parents[FindRoot(parents, i)] = FindRoot(parents, j)
+    else:
+        InitWorker(bits)
+        for ii, jj, _ in map(MatchTile, tiles):
+            for i, j in zip(ii.tolist(), jj.tolist()):
+                parents[FindRoot(parents, i)] = FindRoot(parents, j)
+
+    groups = {}
+    for i in range(len(bits)):
+        groups.setdefault(FindRoot(parents, i), []).append(i)
+
+    return sorted((x for x in groups.values() if len(x) > 1), key=lambda x: x[0])
+
+def RankGroup(hashlist, members):
+    """Order members so the one to keep comes first
+
+    Images beating more of the group in both dimensions (as _PerceptualHashScore judges it) go first,
+    then larger images, then older entries"""
+    def Rank(row):
+        ph = hashlist.hashList.Perceptual(row)
+        wins = sum(1 for other in members if other != row and hashlist.ComparePerceptualSizes(ph, hashlist.hashList.Perceptual(other)) > 0)
+        return (-wins, -(ph[1] * ph[2]), row)
+
+    return sorted(members, key=Rank)
+
+def PrintGroups(hashlist, rows, bits, groups):
+    labels = {1: "LARGER", 0: "CROPPED", -1: "SMALLER"}
+    nbits = bits.shape[1] * 8
+
+    for number, group in enumerate(groups):
+        ranked = RankGroup(hashlist, [rows[x] for x in group])
+        position = {rows[x]: x for x in group}
+
+        keep = ranked[0]
+        keepPh = hashlist.hashList.Perceptual(keep)
+
+        print("[GROUP] {} ({} images)".format(number, len(ranked)))
+        print("[KEEP] {} ({}x{})".format(hashlist.hashList.Path(keep), keepPh[1], keepPh[2]))
+
+        distances = HashStore.HammingDistances(bits[[position[row] for row in ranked[1:]]], bits[position[keep]][None, :])[:, 0]
+
+        for row, distance in zip(ranked[1:], distances):
+            ph = hashlist.hashList.Perceptual(row)
+            label = labels[hashlist.ComparePerceptualSizes(ph, keepPh)]
+            print("[DUP][{}] {} ({}x{}) at {:02%}".format(label, hashlist.hashList.Path(row), ph[1], ph[2], 1 - distance / nbits))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Finds groups of perceptually similar images across a whole hashtable")
+    parser.add_argument('-t', '--hashtable', nargs=1, type=str, help='Location of hashtable')
+    parser.add_argument('--threshold', type=float, default=HashList.GLOBAL_LOG_THRESHOLD, help='Largest normalised Hamming distance counted as similar')
+    parser.add_argument('--tile', type=int, default=1024, help='Images per side of each block of distances. Memory use is around 40 * tile^2 bytes per process')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of processes computing distances')
+
+    args = parser.parse_args()
+
+    encodedHashtable = args.hashtable[0].encode() if args.hashtable else b".!HashList"
+
+    if not os.path.exists(encodedHashtable):
+        raise IOError("Hashtable \"{}\" does not exist".format(encodedHashtable))
+
+    hashlist = HashList.CHashList(encodedHashtable)
+
+    if not HashList.EXT_PerceptualHash in hashlist.capabilities:
+        print("[WARN] Table was not made with perceptual hashing (-p). There is nothing to cluster", file=sys.stderr)
+
+    rows, bits = hashlist.GetPerceptualHashes()
+    print("[INFO] Clustering {} images".format(len(rows)))
+
+    # Same test as the scan: distance below the threshold
+    radius = int(numpy.ceil(args.threshold * bits.shape[1] * 8)) - 1
+
+    groups = ClusterBits(bits, radius, args.tile, args.jobs)
+    PrintGroups(hashlist, rows, bits, groups)
@@ -5,6 +5,7 @@ import os
 import numpy
 import argparse
 from HashUtil import HashList
+from HashUtil import Extensions
 
 def CompareTables(masterTable, comparisonTable):
     print("Comparing {} to {}".format(comparisonTable, masterTable))
@@ -15,12 +16,35 @@ def CompareTables(masterTable, comparisonTable):
     print("Loading {}".format(comparisonTable.encode()))
     cTable = HashList.CHashList(comparisonTable.encode())
 
-    for sz, shs, lhs, nm, ph in cTable.hashList:
-        # Check if cElement's hash is known by mTable
-        #if not mTable._DoesShortHashCollide(sz, nm, shs, True):
-        mTable._DoesPerceptualHashCollide(sz, nm, ph, False)
-        
-        if not mTable._DoesLongHashCollide(sz, nm, lhs, True):
+    # Tables made with different short hash blocks or providers share no short hashes, so entries
+    # with a long hash are matched on that alone
+    sharesShort = mTable.SharesHashes(cTable, Extensions.SHORT_HASH_CAPABILITIES)
+    if not sharesShort:
+        print("[WARN] {} and {} take short hashes differently. Entries with only a short hash can't be matched".format(comparisonTable, masterTable), file=sys.stderr)
+
+    if not mTable.SharesHashes(cTable, Extensions.LONG_HASH_CAPABILITIES):
+        print("[WARN] {} and {} take long hashes differently. Nothing is likely to match".format(comparisonTable, masterTable), file=sys.stderr)
+
+    # Near duplicate images are reported either way
+    comparePerceptual = Extensions.EXT_PerceptualHash in mTable.capabilities
+
+    for entry in cTable.hashList:
+        sz, shs, lhs, nm, ph = entry
+
+        if comparePerceptual and ph is not None:
+            mTable._DoesPerceptualHashCollide(sz, nm, ph, False)
+
+        if lhs is not None:
+            known = mTable._DoesLongHashCollide(sz, nm, lhs, True)
+        elif sharesShort:
+            # Check if cElement's hash is known by mTable. Nothing gets read, the hashes come from cTable
+            # With no long hash to go on, a short hash match is all there is
+            result = mTable.CheckAndAddElement(None, nm[0], nm[1], allowLongHashes=False, silent=False, element=mTable.EntryElement(entry), addUnknown=False)
+            known = result.IsKnown()
+        else:
+            known = False
+
+        if not known:
             print("[ONLY][{}] {}".format(comparisonTable, nm[0]))
         else:
             print("[BOTH][----] {}".format(nm[0]))
@@ -5,9 +5,15 @@ import sys
 import os
 import argparse
 import platform
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from HashUtil import HashList
 from HashUtil import Utils
 from HashUtil import Extensions
+from HashUtil import Reader
+from HashUtil import HashStore
+from HashUtil import Walker
+from HashUtil import Layout
 
 def MoveFileToQuarantine(r, fl, args):
     Utils.Quarantine(r, fl, args, "../.!Quarantine")
@@ -54,9 +60,6 @@ def IsDriveSafe(a,b):
     return True
 
     
-def GetExtension(filename: str):
-    return filename.split(".")[-1].lower().encode()
-
 def GetHashExtensions(arguments: argparse.Namespace):
     HashExts = []
 
@@ -71,16 +74,189 @@ def GetHashExtensions(arguments: argparse.Namespace):
         print("[EXTENSION] Perceptual Hashing Enabled")
         HashExts.append(Extensions.EXT_PerceptualHash)
 
+        if not arguments.full_resolution:
+            print("[EXTENSION] Reduced Perceptual Decode Enabled")
+            HashExts.append(Extensions.EXT_ReducedPerceptualDecode)
+
     if arguments.sha512:
         print("[EXTENSION] SHA512 Enabled")
         HashExts.append(Extensions.EXT_SHA512)
 
+    if arguments.blake2b:
+        print("[EXTENSION] BLAKE2b Enabled")
+        HashExts.append(Extensions.EXT_BLAKE2b)
+    elif arguments.blake2s:
+        print("[EXTENSION] BLAKE2s Enabled")
+        HashExts.append(Extensions.EXT_BLAKE2s)
+
+    if arguments.tree_hash:
+        print("[EXTENSION] Tree Long Hash Enabled")
+        HashExts.append(Extensions.EXT_TreeLongHash)
+
     if arguments.centred_short_hash:
         print("[EXTENSION] Centred Short Hash Block Enabled")
         HashExts.append(Extensions.EXT_IncludeFileMiddleInShortHash)
 
+    # On by default. Much cheaper than decoding, and just as blind to metadata
+    if not arguments.decode_pixels:
+        print("[EXTENSION] Container Payload Hashing Enabled")
+        HashExts.append(Extensions.EXT_ContainerPayloadHash)
+
     return HashExts
 
+def WalkFiles(args, hashlist):
+    """Yield the files to scan in os.walk order. Skipped folders come through with no file so they print in order"""
+    for r, fi, relp, ext, stat in Walker.Walk(args.path, excludeDirs, excludeFileTypes, args.walk_jobs):
+        if fi is None:
+            yield (r, None, None, None, None)
+            continue
+
+        # Anything the walk reaches survives the prune
+        hashlist.MarkVisited(relp)
+
+        # The walk's stat is passed on, so the file isn't stat'ed again to hash it
+        if args.incremental and stat is not None and hashlist.IsElementUnchanged(relp, stat):
+            continue
+
+        yield (r, fi, relp, ext, stat)
+
+def HintAhead(hashlist, items):
+    """Pass items through, having the OS start reading each file a few files before it's reached"""
+    queued = collections.deque()
+
+    for item in items:
+        if item[1] is not None:
+            hashlist.reader.Hint(os.path.join(item[0], item[1]))
+
+        queued.append(item)
+        if len(queued) > Reader.READ_AHEAD_FILES:
+            yield queued.popleft()
+
+    yield from queued
+
+def NeedsContentHash(hashlist, stat, args):
+    """Whether a worker should hash a file's contents. Decided on the main thread, which owns the table's indices"""
+    # The table may gain this size before the main thread gets to the file. If so, it hashes what's missing itself
+    return not args.size_first or stat is None or hashlist.IsSizeKnown(stat.st_size)
+
+def HashWorker(hashlist, pathAsBytes, relp, ext, stat, bNeedsContentHash, args):
+    """Runs on the pool. Only hashes; the table is left to the main thread"""
+    element = hashlist.HashElement(pathAsBytes, relp, ext, useRawHashes=args.raw, stat=stat)
+
+    element.Prime(useLongHash=(bNeedsContentHash and not args.short_hash), usePerceptualHash=(Extensions.EXT_PerceptualHash in hashlist.capabilities), useShortHash=bNeedsContentHash)
+    return element
+
+def ProcessFile(hashlist, pathAsBytes, item, args, future=None):
+    r, fi, relp, ext, stat = item
+
+    if fi is None:
+        print("Skipping Below {}".format(r))
+        return
+
+    element = None
+
+    try:
+        if future is not None:
+            # Surfaces any exception raised on the worker
+            element = future.result()
+            element.FlushWarnings()
+        else:
+            element = hashlist.HashElement(pathAsBytes, relp, ext, useRawHashes=args.raw, stat=stat)
+
+        oldSegments = None
+        if args.incremental:
+            oldSegments = hashlist.SegmentsAtPath(relp)
+
+            # New or modified. Whatever we had for this path is stale
+            hashlist.ForgetElement(relp)
+
+        result = hashlist.CheckAndAddElement(pathAsBytes, relp, ext, allowLongHashes=(not (args.fast and args.short_hash)), silent=args.silent, useRawHashes=args.raw, useLongHash=(not args.short_hash), element=element, deferHashes=args.size_first)
+
+        if oldSegments is not None and element.Segments() is not None:
+            changed = hashlist.ChangedSegments(oldSegments, element.Segments())
+
+            if changed:
+                print("[MODIFIED] File {} differs in {} of {} segments: {}".format(relp, len(changed), len(element.Segments()) // HashStore.DIGEST_SIZE, changed))
+            else:
+                # Touched, say, but the same inside
+                print("[UNCHANGED] File {} has new metadata, but the same contents".format(relp))
+
+        if result.status == HashList.RESULT_ADDED:
+            print("[ADDITION] File: {}".format(relp))
+        else:
+            if args.allow_quarantine:
+                MoveFileToQuarantine(r, (fi, ext), args)  
+    except KeyboardInterrupt as kbi:
+        raise kbi
+    except Exception as e:
+        print("Error on file {}: {}".format(fi, e), file=sys.stderr)
+    finally:
+        if element is not None:
+            element.Close()
+
+def ScanParallel(hashlist, pathAsBytes, items, args):
+    """Hash on a pool of threads, but look up and insert on this one in walk order.
+    Results match a serial scan regardless of the number of workers"""
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        pending = collections.deque()
+
+        for item in items:
+            future = None
+            if item[1] is not None:
+                future = pool.submit(HashWorker, hashlist, pathAsBytes, item[2], item[3], item[4], NeedsContentHash(hashlist, item[4], args), args)
+
+            pending.append((item, future))
+
+            # Keep the pool fed, but don't run too far ahead of the table
+            if len(pending) >= args.jobs * 4:
+                pendingItem, pendingFuture = pending.popleft()
+                ProcessFile(hashlist, pathAsBytes, pendingItem, args, pendingFuture)
+
+        while pending:
+            pendingItem, pendingFuture = pending.popleft()
+            ProcessFile(hashlist, pathAsBytes, pendingItem, args, pendingFuture)
+
+def Batches(items, size):
+    batch = []
+
+    for item in items:
+        batch.append(item)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def ScanScheduled(hashlist, pathAsBytes, items, args):
+    """Hash each batch of files in the order they lie on disk, to save seeking, but look up and insert in walk order.
+    Results match a walk order scan. The next batch is read while this one is looked up"""
+    def Submit(batch):
+        files = [(os.path.join(r, fi) if fi is not None else r, stat) for r, fi, relp, ext, stat in batch]
+        futures = [None] * len(batch)
+
+        for i in Layout.Schedule(files, args.read_order):
+            if batch[i][1] is not None:
+                futures[i] = pool.submit(HashWorker, hashlist, pathAsBytes, batch[i][2], batch[i][3], batch[i][4], NeedsContentHash(hashlist, batch[i][4], args), args)
+
+        return list(zip(batch, futures))
+
+    # More than one reader seeks between files again, so only go wider when asked
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        previous = []
+
+        for batch in Batches(items, args.read_batch):
+            current = Submit(batch)
+
+            for pendingItem, pendingFuture in previous:
+                ProcessFile(hashlist, pathAsBytes, pendingItem, args, pendingFuture)
+
+            previous = current
+
+        for pendingItem, pendingFuture in previous:
+            ProcessFile(hashlist, pathAsBytes, pendingItem, args, pendingFuture)
+
 excludeDirs = [".git"]
 excludeFileTypes = [b"gitignore", b"gitmodules"]
 
@@ -94,10 +270,28 @@ if __name__ == "__main__":
     parser.add_argument("--silent", action="store_true", help='Silence output')
     parser.add_argument('-t', '--hashtable', nargs=1, type=str, help='Location of hashtable')
     parser.add_argument('--sha512', action="store_true", help='Use SHA512_256 over SHA3_256')
+    parser.add_argument('--blake2b', action="store_true", help='Use BLAKE2b over SHA3_256. Faster than SHA3_256, about as fast as SHA512_256 on 64 bit machines')
+    parser.add_argument('--blake2s', action="store_true", help='Use BLAKE2s over SHA3_256. Faster on 32 bit machines')
     parser.add_argument('-p', '--perceptual', action="store_true", help='Use Perceptual Hashing')
+    parser.add_argument('--tree-hash', action="store_true", help='Hash large files in segments on several threads, combined as a Merkle tree')
+    parser.add_argument('--tree-jobs', type=int, default=os.cpu_count(), help='Threads hashing the segments of one file')
     parser.add_argument('-ch', '--centred-short-hash', action="store_true", help='Add a third, infixed hash block for short hash')
     parser.add_argument('-mb', '--medium-block', action="store_true", help='Use 1MiB short hash block size, up from 4Ki')
     parser.add_argument('-lb', '--large-block', action="store_true", help='Use 16MiB short hash block size, up from 4Ki or 1Mi')
+    parser.add_argument('-dp', '--decode-pixels', action="store_true", help='Hash the decoded pixels of JPEG and PNG files instead of their compressed data. Slower')
+    parser.add_argument('-fr', '--full-resolution', action="store_true", help='Decode images in full for perceptual hashing, rather than at the scale the hash needs')
+    parser.add_argument('--chunk-size', type=int, default=Reader.DEFAULT_CHUNK_SIZE // (1024 * 1024), help='MiB read at a time when hashing a whole file. Each hashing thread keeps a buffer this large')
+    parser.add_argument('--read-ahead', action="store_true", help='Read the next chunk of a file while the last is hashed, and have the OS start on the files queued next. Doubles the memory --chunk-size takes')
+    parser.add_argument('--drop-cache', action="store_true", help='Drop files from the page cache once hashed, so a large scan doesn\'t push out what other programs are using')
+    parser.add_argument('--max-read-rate', type=float, default=0, help='Cap on MiB read per second, across every thread. 0 for no cap')
+    parser.add_argument('--pixel-memory', type=int, default=HashList.PIXEL_STRIP_BYTES // (1024 * 1024), help='MiB of pixels copied out of an image at a time while hashing it, on top of the decoded image')
+    parser.add_argument('--max-decode', type=int, default=0, help='MiB an image may take decoded. Larger ones are hashed as files, with no perceptual hash, so their hashes differ from a table made without the limit. 0 (the default) is no limit')
+    parser.add_argument('-sf', '--size-first', action="store_true", help='Only hash files once a second file of the same size turns up')
+    parser.add_argument('-i', '--incremental', action="store_true", help='Skip files whose device, inode, size and mtime match the table')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Number of threads hashing files. 0 hashes on the main thread')
+    parser.add_argument('--read-order', choices=Layout.ORDERS, default=Layout.ORDER_WALK, help='Order files are read in. Inode or extent (where each file starts on disk) saves seeking on hard drives. Results are the same either way')
+    parser.add_argument('--read-batch', type=int, default=Layout.DEFAULT_BATCH_SIZE, help='Files put in order at a time with --read-order')
+    parser.add_argument('--walk-jobs', type=int, default=1, help='Threads listing folders and stat\'ing files ahead of the hashing. Speeds up network filesystems')
     parser.add_argument("path", metavar="path", type=str)
 
     args = parser.parse_args()
@@ -135,35 +329,27 @@ if __name__ == "__main__":
     WantedExtensions = GetHashExtensions(args)
 
     hashlist = HashList.CHashList(encodedHashtable, WantedExtensions)
-    hashlist.Prune(pathAsBytes, dry_run=False, silent=args.silent)
-
-    for r, d, p in os.walk(args.path):
-        d[:] = [x for x in d if x not in excludeDirs]
-        p[:] = [x for x in p if GetExtension(x) not in excludeFileTypes]
-
-        if ".skipfolder" in p:
-            d[:] = []#[x for x in d]
-            print("Skipping Below {}".format(r))
-            continue
-
-        for fi in p:
-            # Let's catagorise these
-            f = fi.split(".")
-            path = os.path.join(r, fi)
-            relp = os.path.relpath(path, os.path.abspath(args.path)).encode()
-            ext = f[len(f) - 1].lower().encode()
-
-            try:
-                if not hashlist.IsElementKnown(pathAsBytes, relp, ext, allowLongHashes=(not (args.fast and args.short_hash)), silent=args.silent, useRawHashes=args.raw):
-                    print("[ADDITION] File: {}".format(relp))
-                    hashlist.AddElement(pathAsBytes, relp, ext, silent=args.silent, useLongHash=(not args.short_hash), useRawHashes=args.raw)
-                else:
-                    if args.allow_quarantine:
-                        MoveFileToQuarantine(r, (fi, ext), args)  
-            except KeyboardInterrupt as kbi:
-                raise kbi
-            except Exception as e:
-                print("Error on file {}: {}".format(fi, e), file=sys.stderr)
-                continue
+    hashlist.pixelStripBytes = args.pixel_memory * 1024 * 1024
+    hashlist.maxDecodedBytes = args.max_decode * 1024 * 1024 if args.max_decode > 0 else None
+    hashlist.reader.chunkSize = args.chunk_size * 1024 * 1024
+    hashlist.treeJobs = args.tree_jobs
+    hashlist.reader.dropCache = args.drop_cache
+    if args.max_read_rate > 0:
+        hashlist.reader.throttle = Reader.CThrottle(args.max_read_rate * 1024 * 1024)
+    hashlist.BeginPrune(pathAsBytes)
+
+    items = WalkFiles(args, hashlist)
+    if args.read_ahead:
+        hashlist.reader.readAhead = max(args.jobs, args.tree_jobs if args.tree_hash else 0, 1)
+        items = HintAhead(hashlist, items)
+
+    if args.read_order != Layout.ORDER_WALK:
+        ScanScheduled(hashlist, pathAsBytes, items, args)
+    elif args.jobs > 0:
+        ScanParallel(hashlist, pathAsBytes, items, args)
+    else:
+        for item in items:
+            ProcessFile(hashlist, pathAsBytes, item, args)
 
+    hashlist.FinishPrune(dry_run=False, silent=args.silent)
     hashlist.Write()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import hashlib
+import numpy
+from . import Reader
+
+# Chunks average about this many bytes. Smaller finds more sharing, but costs more index
+DEFAULT_AVERAGE_SIZE = 8 * 1024
+
+# Files are chunked this much at a time. Working memory is a few dozen times this
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Chunks in more files than this aren't paired up when working out what files share
+DEFAULT_MAX_HOLDERS = 64
+
+# Bytes in the rolling hash's window. A boundary depends on these alone
+WINDOW_SIZE = 48
+
+# The rolling hash is sum(GEAR[b] * PRIME^age) over the window, mod 2^64. Both are fixed so boundaries
+# (and so chunk digests) are the same from run to run
+GEAR = numpy.random.default_rng(0x5EED).integers(0, 2 ** 64, size=256, dtype=numpy.uint64)
+PRIME = 0x9E3779B97F4A7C15
+PRIME_INVERSE = pow(PRIME, -1, 2 ** 64)
+
+
+def _Powers(base, count):
+    powers = numpy.full(count, base, dtype=numpy.uint64)
+    powers[0] = 1
+    # Wraps mod 2^64, as wanted
+    with numpy.errstate(over="ignore"):
+        return numpy.cumprod(powers, dtype=numpy.uint64)
+
+
+class CChunker():
+    """
+    Splits files at content defined boundaries, so an insertion only changes the chunks around it
+
+    A boundary falls after any byte where the rolling hash of the last WINDOW_SIZE bytes is below a
+    threshold. The hash is computed for a whole block at once with prefix sums, rather than byte by
+    byte. Chunks are at least a quarter and at most eight times the average size
+    """
+
+    def __init__(self, averageSize=DEFAULT_AVERAGE_SIZE, blockSize=DEFAULT_BLOCK_SIZE):
+        self.minSize = max(averageSize // 4, WINDOW_SIZE)
+        self.maxSize = averageSize * 8
+        self.blockSize = blockSize
+
+        # Past the minimum, a boundary is this likely after each byte
+        self.threshold = numpy.uint64(2 ** 64 // max(averageSize - self.minSize, 1))
+
+        self.reader = Reader.CFileReader(blockSize)
+        self.powers = _Powers(PRIME, blockSize + WINDOW_SIZE)
+        self.inversePowers = _Powers(PRIME_INVERSE, blockSize + WINDOW_SIZE)
+
+    def _Candidates(self, data):
+        """Offsets into data just after each byte whose window hashes to a boundary"""
+        n = len(data)
+        if n < WINDOW_SIZE:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        gears = GEAR[numpy.frombuffer(data, dtype=numpy.uint8)]
+
+        # In place where possible. These arrays are eight times the size of the data
+        with numpy.errstate(over="ignore"):
+            numpy.multiply(gears, self.inversePowers[:n], out=gears)
+
+            sums = numpy.empty(n + 1, dtype=numpy.uint64)
+            sums[0] = 0
+            numpy.cumsum(gears, out=sums[1:])
+
+            # Window ending at i: PRIME^i * (sums[i + 1] - sums[i + 1 - WINDOW_SIZE])
+            hashes = gears[:n + 1 - WINDOW_SIZE]
+            numpy.subtract(sums[WINDOW_SIZE:], sums[:n + 1 - WINDOW_SIZE], out=hashes)
+            numpy.multiply(hashes, self.powers[WINDOW_SIZE - 1:n], out=hashes)
+
+        return numpy.flatnonzero(hashes < self.threshold) + WINDOW_SIZE
+
+    def _Cuts(self, candidates, start, blockEnd):
+        """Chunk ends up to blockEnd, given where the current chunk starts and the boundaries found"""
+        cuts = []
+
+        for cut in candidates:
+            # Too long without a boundary. Cut anyway
+            while cut - start > self.maxSize:
+                start += self.maxSize
+                cuts.append(start)
+
+            if cut - start >= self.minSize:
+                cuts.append(cut)
+                start = cut
+
+        while blockEnd - start > self.maxSize:
+            start += self.maxSize
+            cuts.append(start)
+
+        return cuts
+
+    def Chunks(self, fileObj):
+        """Yield (key, size) for each chunk of the file, reading it a block at a time"""
+        tail = b""
+        offset = 0
+        start = 0
+        digest = hashlib.blake2b(digest_size=8)
+
+        for block in self.reader.Chunks(fileObj):
+            # The end of the previous block starts the first windows of this one
+            data = tail + bytes(block)
+            blockEnd = offset + len(block)
+
+            candidates = (self._Candidates(data) + (offset - len(tail))).tolist()
+            position = offset
+
+            for cut in self._Cuts(candidates, start, blockEnd):
+                digest.update(block[position - offset:cut - offset])
+                yield int.from_bytes(digest.digest(), "little"), cut - start
+
+                digest = hashlib.blake2b(digest_size=8)
+                start = position = cut
+
+            digest.update(block[position - offset:])
+            tail = data[-(WINDOW_SIZE - 1):]
+            offset = blockEnd
+
+        if offset > start:
+            yield int.from_bytes(digest.digest(), "little"), offset - start
+
+    def ChunkFile(self, fileObj):
+        """Keys and sizes of every chunk, as arrays"""
+        keys = []
+        sizes = []
+
+        for key, size in self.Chunks(fileObj):
+            keys.append(key)
+            sizes.append(size)
+
+        return numpy.array(keys, dtype=numpy.uint64), numpy.array(sizes, dtype=numpy.int64)
+
+
+class CChunkIndex():
+    """
+    Chunk keys of many files, for working out how much of them is shared
+
+    Each file's chunks sit in arrays, so millions of chunks cost a dozen or so bytes each
+    """
+
+    def __init__(self):
+        self.names = []
+        self.keys = []
+        self.sizes = []
+
+    def Add(self, name, keys, sizes):
+        self.names.append(name)
+        self.keys.append(keys)
+        self.sizes.append(sizes)
+        return len(self.names) - 1
+
+    def __len__(self):
+        return len(self.names)
+
+    def _All(self):
+        if not self.names:
+            return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+        files = numpy.concatenate([numpy.full(len(x), i, dtype=numpy.int64) for i, x in enumerate(self.keys)])
+        return numpy.concatenate(self.keys), numpy.concatenate(self.sizes), files
+
+    def TotalBytes(self):
+        return int(sum(x.sum() for x in self.sizes))
+
+    def UniqueBytes(self):
+        """Bytes left if every chunk were only stored once"""
+        keys, sizes, _ = self._All()
+        _, first = numpy.unique(keys, return_index=True)
+        return int(sizes[first].sum())
+
+    def FileBytes(self, file):
+        return int(self.sizes[file].sum())
+
+    def SharedBytes(self, maxHolders=DEFAULT_MAX_HOLDERS):
+        """
+        ({(a, b): bytes}, a < b, for each pair of files with chunks in common, chunks left out)
+
+        Bytes are counted once per distinct chunk the pair shares. Chunks held by more than
+        maxHolders files (runs of zeros, common headers) would add a pair for every two of them,
+        so they're left out. Their number is returned
+        """
+        keys, sizes, files = self._All()
+
+        # One of each chunk per file
+        order = numpy.lexsort((files, keys))
+        keys, sizes, files = keys[order], sizes[order], files[order]
+        distinct = numpy.ones(len(keys), dtype=bool)
+        distinct[1:] = (keys[1:] != keys[:-1]) | (files[1:] != files[:-1])
+        keys, sizes, files = keys[distinct], sizes[distinct], files[distinct]
+
+        # Only chunks in more than one file matter
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(keys)))
+
+        pairKeys = []
+        pairBytes = []
+
+        # Chunks with the same number of holders are paired up together, as rows of a matrix
+        for count in numpy.unique(counts[(counts > 1) & (counts <= maxHolders)]).tolist():
+            groupStarts = starts[counts == count]
+            holders = files[groupStarts[:, None] + numpy.arange(count)]
+            first, second = numpy.triu_indices(count, 1)
+
+            pairKeys.append((holders[:, first] * len(self.names) + holders[:, second]).ravel())
+            pairBytes.append(numpy.repeat(sizes[groupStarts], len(first)))
+
+        if not pairKeys:
+            return {}, int((counts > maxHolders).sum())
+
+        pairs, inverse = numpy.unique(numpy.concatenate(pairKeys), return_inverse=True)
+        totals = numpy.bincount(inverse, weights=numpy.concatenate(pairBytes))
+
+        shared = {(int(pair) // len(self.names), int(pair) % len(self.names)): int(total) for pair, total in zip(pairs.tolist(), totals.tolist())}
+        return shared, int((counts > maxHolders).sum())
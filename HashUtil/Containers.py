@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import re
+
+# Types whose compressed image data can be pulled out of the container
+PAYLOAD_TYPES = [b"jpg", b"jpeg", b"png"]
+
+JPEG_SIGNATURE = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Inside a scan, 0xFF is always followed by a stuffed 0x00 or a restart marker. Anything else ends the scan
+_JPEG_SCAN_END = re.compile(rb"\xff[^\x00\xd0-\xd7]")
+
+# Everything needed to decode the image. Text, EXIF, timestamps and colour metadata are left out
+_PNG_PAYLOAD_CHUNKS = [b"IHDR", b"PLTE", b"tRNS", b"IDAT", b"acTL", b"fcTL", b"fdAT"]
+
+
+def IsPayloadType(extension):
+    return extension.lower() in PAYLOAD_TYPES
+
+def _IsJpegMetadata(marker):
+    # APPn and COM. APP14 (Adobe) stays, it says how to convert the colours
+    return (0xE0 <= marker <= 0xEF and marker != 0xEE) or marker == 0xFE
+
+def _JpegPayload(data):
+    view = memoryview(data)
+    pieces = []
+
+    pos = len(JPEG_SIGNATURE)
+    while True:
+        if pos >= len(data) or data[pos] != 0xFF:
+            raise ValueError("Expected a JPEG marker at offset {}".format(pos))
+
+        # Markers may be padded with any number of 0xFF
+        while pos < len(data) and data[pos] == 0xFF:
+            pos += 1
+
+        if pos >= len(data):
+            raise ValueError("JPEG ends inside a marker")
+
+        marker = data[pos]
+        pos += 1
+
+        if marker == 0xD9:
+            # EOI. Anything after it isn't part of this image
+            return pieces
+
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            # Standalone markers have no length
+            pieces.append(view[pos - 2:pos])
+            continue
+
+        if pos + 2 > len(data):
+            raise ValueError("JPEG ends inside a segment header")
+
+        length = int.from_bytes(data[pos:pos + 2], "big")
+        end = pos + length
+
+        if length < 2 or end > len(data):
+            raise ValueError("JPEG segment at offset {} runs past the end of the file".format(pos))
+
+        if not _IsJpegMetadata(marker):
+            pieces.append(view[pos - 2:end])
+
+        pos = end
+
+        if marker == 0xDA:
+            # SOS. Entropy-coded data follows the header
+            match = _JPEG_SCAN_END.search(data, pos)
+            scanEnd = match.start() if match else len(data)
+
+            pieces.append(view[pos:scanEnd])
+            pos = scanEnd
+
+            if match is None:
+                # Truncated before EOI. Take what there is
+                return pieces
+
+def _PngPayload(data):
+    view = memoryview(data)
+    pieces = []
+
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], "big")
+        chunkType = bytes(data[pos + 4:pos + 8])
+
+        start = pos + 8
+        end = start + length
+
+        if end + 4 > len(data):
+            raise ValueError("PNG chunk {} runs past the end of the file".format(chunkType))
+
+        if chunkType in _PNG_PAYLOAD_CHUNKS:
+            # IDAT is one stream, however it's split up, so only its data counts
+            if chunkType != b"IDAT":
+                pieces.append(chunkType)
+            pieces.append(view[start:end])
+
+        # Skip the CRC too
+        pos = end + 4
+
+        if chunkType == b"IEND":
+            return pieces
+
+    raise ValueError("PNG has no IEND chunk")
+
+def PayloadOf(data):
+    """
+    The parts of a JPEG or PNG that make up the image, in order, leaving the metadata out
+
+    Pieces are memoryviews into data where possible. Files are told apart by signature, not extension
+
+    Raises:
+        ValueError when data is neither, or the container is broken
+    """
+    if data.startswith(JPEG_SIGNATURE):
+        return _JpegPayload(data)
+
+    if data.startswith(PNG_SIGNATURE):
+        return _PngPayload(data)
+
+    raise ValueError("Not a JPEG or PNG")
+
+def Slice(pieces, start, end):
+    """Yield the bytes from start to end of the pieces joined together, without joining them"""
+    offset = 0
+
+    for piece in pieces:
+        pieceEnd = offset + len(piece)
+
+        if pieceEnd > start and offset < end:
+            yield piece[max(start - offset, 0):min(end - offset, len(piece))]
+
+        offset = pieceEnd
+
+        if offset >= end:
+            break
@@ -3,3 +3,14 @@ EXT_SHA512 = "EXT_SHA512"
 EXT_16MiBShortHashBlock = "EXT_16MiBShortHashBlock"
 EXT_1MiBShortHashBlock = "EXT_1MiBShortHashBlock"
 EXT_IncludeFileMiddleInShortHash = "EXT_IncludeFileMiddleInShortHash"
+EXT_ContainerPayloadHash = "EXT_ContainerPayloadHash"
+EXT_ReducedPerceptualDecode = "EXT_ReducedPerceptualDecode"
+EXT_BLAKE2b = "EXT_BLAKE2b"
+EXT_BLAKE2s = "EXT_BLAKE2s"
+EXT_TreeLongHash = "EXT_TreeLongHash"
+
+# Tables only share short hashes if they agree on these
+SHORT_HASH_CAPABILITIES = [EXT_SHA512, EXT_BLAKE2b, EXT_BLAKE2s, EXT_16MiBShortHashBlock, EXT_1MiBShortHashBlock, EXT_IncludeFileMiddleInShortHash, EXT_ContainerPayloadHash]
+
+# Likewise for long hashes
+LONG_HASH_CAPABILITIES = [EXT_SHA512, EXT_BLAKE2b, EXT_BLAKE2s, EXT_ContainerPayloadHash, EXT_TreeLongHash]
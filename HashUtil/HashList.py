@@ -3,14 +3,22 @@
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 import cryptography
+import cryptography.exceptions
 import pickle
+import hashlib
+import base64
 import os
 import sys
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import perception
 from . import Utils
 from . import EncryptionHelpers
+from . import HashStore
+from . import Containers
+from . import Reader
 from .Extensions import *
 import platform # Needed for the platform check
 
@@ -32,41 +40,437 @@ PERC_supportedVideoTypes = []#b"mp4", b"mov", b"ts", b"flv", b"mpeg", b"mkv"]
 # Declare a version number for easier sorting of multiple versions of the format
 # I may occasionally add stuff to the format, so I'd like to avoid breaking it
 # The first version of this may break stuff though
-HASHLIST_VERSION_NUMBER = 3
+HASHLIST_VERSION_NUMBER = 5
+JOURNAL_VERSION_NUMBER = 1
 GLOBAL_HASH_SIZE = 16
+# PHash shrinks every image to GLOBAL_HASH_SIZE * this on a side. Decoding any finer is wasted
+GLOBAL_HIGHFREQ_FACTOR = 128
 HASH_CLIP = 64
 GLOBAL_LOG_THRESHOLD = 0.1
 
+# PHash bits, and how many of them may differ before images stop counting as near duplicates
+PERCEPTUAL_HASH_BYTES = GLOBAL_HASH_SIZE * GLOBAL_HASH_SIZE // 8
+PERCEPTUAL_NEAR_RADIUS = int(GLOBAL_LOG_THRESHOLD * PERCEPTUAL_HASH_BYTES * 8)
+
+# Pixels are hashed a strip of rows at a time, each strip at most this large (one row at least).
+# Expect a few copies of a strip alive at once on top of the decoded image
+PIXEL_STRIP_BYTES = 16 * 1024 * 1024
+
+# PIL decodes an image whole. With a limit, images that would take more than it decoded are hashed
+# as plain files instead, and get no perceptual hash. Their hashes then differ from those of tables
+# made without the limit, so there is none unless asked for
+MAX_DECODED_BYTES = None
+
+# Tree hashing (EXT_TreeLongHash) digests files in segments of this size, then combines them as a
+# Merkle tree. Leaves are H(0x00 | segment), nodes H(0x01 | left | right), and an odd node out is
+# carried up a level as it is. Changing the size changes every tree hash
+TREE_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Plain long hashes note the digest of each of these prefixes on the way (see CHashLadder). A file
+# that short collides is compared a prefix at a time, so one that differs early is rejected early
+TIER_SIZES = [1024 * 1024, 64 * 1024 * 1024]
+
 # About Versions
 # 1 is the defacto for the older format. It's actually unused since the old format doesn't have any numbering
 # 2 adds support for perceptual hashing when enabled
 # 3 adds capabilities
+# 4 adds a dictionary of optional sections, starting with the stat cache
+# 5 stores entries as columns (see HashStore). Stat data moves into the columns
+
+# About Journals
+# Checkpoints append to <table>.journal rather than rewriting the table. Each record is an
+# 8 byte little endian length followed by the encrypted (version, changes) pair. Records are
+# authenticated against the hash of the table file they build on, so a journal left over
+# from an older table fails to decrypt and is ignored
 
 SUPPORTED_CAPABILITIES = []
 
+# Inverted indices saved with the table (see CHashList._Gin)
+GIN_NAMES = ["Size", "Short", "Long", "Paths", "Perceptual", "PerceptualNear"]
+
+# Outcomes of CHashList.CheckAndAddElement
+RESULT_EMPTY = "Empty"
+RESULT_KNOWN = "Known"
+RESULT_ADDED = "Added"
+RESULT_UNKNOWN = "Unknown"
+
+
+class CElementResult():
+    """What CheckAndAddElement made of a file
+
+    Status is one of the RESULT_ values. For known elements, index and entry are
+    what it collided with and mode is the hash that matched. For added elements they are the new entry"""
+
+    def __init__(self, status, mode=None, index=None, entry=None):
+        self.status = status
+        self.mode = mode
+        self.index = index
+        self.entry = entry
+
+    def IsKnown(self):
+        # Empty files collide with every other empty file
+        return self.status == RESULT_KNOWN or self.status == RESULT_EMPTY
+
+
+class CHashlibDigest():
+    """A hashlib digest that looks like cryptography's hashes.Hash"""
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def update(self, data):
+        # hashlib lets go of the GIL while it works through large buffers
+        self.digest.update(data)
+
+    def finalize(self):
+        return self.digest.digest()
+
+    def copy(self):
+        return CHashlibDigest(self.digest.copy())
+
+
+class CHashLadder():
+    """A long hash taken a step at a time. Offset is how far it has read, tiers the prefix digests passed"""
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.offset = 0
+        self.tiers = []
+        self.finished = False
+
+
+class CImageTooLargeError(ValueError):
+    """An image that would decode to more memory than allowed"""
+    pass
+
+
+def _DecodedBytes(image):
+    """About how much memory PIL takes to hold the image decoded, from its header alone"""
+    if image.mode in ("I", "F"):
+        bandBytes = 4
+    elif image.mode.startswith("I;16"):
+        bandBytes = 2
+    else:
+        bandBytes = 1
+
+    return image.size[0] * image.size[1] * len(image.getbands()) * bandBytes
+
+
+class CDecodedImage():
+    """
+    An image decoded at most once, however many hashes want its pixels or payload
+
+    A failed decode is remembered and raised again for each later caller, so every
+    hash still reports the bad file the way it would have on its own
+    """
+
+    def __init__(self, fileObj, maxBytes=MAX_DECODED_BYTES):
+        self.fileObj = fileObj
+        self.maxBytes = maxBytes
+        self.reportedTooLarge = False
+        self._image = None
+        self._reduced = None
+        self._size = None
+        self._error = None
+        self._data = None
+        self._payload = None
+        self._payloadError = None
+
+    def Data(self):
+        """The whole file"""
+        if self._data is None:
+            self.fileObj.seek(0)
+            self._data = self.fileObj.read()
+            self.fileObj.seek(0)
+        return self._data
+
+    def Payload(self):
+        """Compressed image data without the container's metadata (see Containers.PayloadOf)"""
+        if self._payloadError is not None:
+            raise self._payloadError
+
+        if self._payload is None:
+            try:
+                self._payload = Containers.PayloadOf(self.Data())
+            except ValueError as e:
+                self._payloadError = e
+                raise
+
+        return self._payload
+
+    def Image(self):
+        """The decoded PIL image"""
+        if self._error is not None:
+            raise self._error
+
+        if self._image is None:
+            try:
+                self.fileObj.seek(0)
+                image = Image.open(self.fileObj)
+                self._size = image.size
+                self._CheckSize(image)
+                image.load()
+            except Exception as e:
+                self._error = e
+                raise
+
+            self._image = image
+
+        return self._image
+
+    def Reduced(self, size):
+        """
+        The image decoded at no less than size, which is far cheaper where the format can scale
+        while decoding (JPEG). Others decode in full. Once the full image exists, that's returned
+        """
+        if self._image is not None:
+            return self._image
+
+        if self._error is not None:
+            raise self._error
+
+        if self._reduced is None:
+            try:
+                self.fileObj.seek(0)
+                image = Image.open(self.fileObj)
+                self._size = image.size
+                image.draft(image.mode, size)
+                self._CheckSize(image)
+                image.load()
+            except Exception as e:
+                self._error = e
+                raise
+
+            self._reduced = image
+
+        return self._reduced
+
+    def _CheckSize(self, image):
+        """Refuse to decode what won't fit. Only the header has been read so far"""
+        if self.maxBytes and _DecodedBytes(image) > self.maxBytes:
+            raise CImageTooLargeError("{}x{} {} image would decode to {} MiB, over the {} MiB limit".format(image.size[0], image.size[1], image.mode, _DecodedBytes(image) // (1024 * 1024), self.maxBytes // (1024 * 1024)))
+
+    def Size(self):
+        """Width and height as stored, whatever scale it was decoded at"""
+        if self._size is None:
+            self.Image()
+        return self._size
+
+    def Close(self):
+        if self._image is not None:
+            self._image.close()
+
+        if self._reduced is not None:
+            self._reduced.close()
+
+        self._image = None
+        self._reduced = None
+        self._data = None
+        self._payload = None
+
+
+class CElementHashes():
+    """Hashes of a single file. Each hash is computed on first use and then kept
+
+    Hashing reads the file but never touches the table, so an element can be
+    primed on a worker thread while another thread owns the CHashList"""
+
+    def __init__(self, hashList, root, relPath, extension, useRawHashes=False, fileSize=None, hashes=None, stat=None):
+        self.hashList = hashList
+        self.relPath = relPath
+        self.extension = extension
+        self.useRawHashes = useRawHashes
+        self.fullPath = os.path.join(root, relPath) if root is not None else None
+        self.stat = None
+
+        if fileSize is None:
+            self.stat = stat if stat is not None else os.stat(self.fullPath)
+            fileSize = self.stat.st_size
+
+        self.fileSize = fileSize
+        self.warnings = []
+
+        self._fileObj = None
+        self._decoded = None
+        self._ladder = None
+        self._hashes = dict(hashes) if hashes else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
+    def _File(self):
+        # Reopened on demand, so primed elements don't hold a handle while queued
+        if self._fileObj is None:
+            if self.fullPath is None:
+                raise IOError("Element {} has no file to hash".format(self.relPath))
+
+            self._fileObj = open(self.fullPath, "rb")
+        return self._fileObj
+
+    def _Decoded(self):
+        # Shared by every hash of this file. Nothing is decoded until a hash asks for pixels
+        if self._decoded is None:
+            self._decoded = CDecodedImage(self._File(), self.hashList.maxDecodedBytes)
+        return self._decoded
+
+    def Close(self):
+        # Pixels can be large, don't keep them around with the handle
+        if self._decoded is not None:
+            self._decoded.Close()
+            self._decoded = None
+
+        if self._fileObj is not None:
+            self.hashList.reader.Release(self._fileObj)
+            self._fileObj.close()
+            self._fileObj = None
+
+    def ShortHash(self):
+        if not "Short" in self._hashes:
+            self._hashes["Short"] = self.hashList._ShortHashSelector(self._File(), self.fileSize, self.relPath, self.extension, self.useRawHashes, self._Decoded())
+        return self._hashes["Short"]
+
+    def _TierCount(self):
+        return sum(1 for x in TIER_SIZES if x < self.fileSize)
+
+    def _Ladder(self):
+        if self._ladder is None:
+            self._ladder = CHashLadder(self.hashList._NewDigest())
+        return self._ladder
+
+    def TierHash(self, tier):
+        """Digest of the first TIER_SIZES[tier] bytes, reading no further than that. None if the file has no such tier"""
+        if "Long" in self._hashes:
+            tiers = self._hashes.get("Tiers") or b""
+            return tiers[tier * HashStore.DIGEST_SIZE:(tier + 1) * HashStore.DIGEST_SIZE] or None
+
+        if self.fullPath is None or tier >= self._TierCount() or not self.hashList._HasLadder(self.extension, self.useRawHashes):
+            return None
+
+        ladder = self._Ladder()
+        self.hashList._AdvanceLadder(self._File(), ladder, self._TierCount(), TIER_SIZES[tier])
+
+        return ladder.tiers[tier] if tier < len(ladder.tiers) else None
+
+    def Tiers(self):
+        """Prefix digests noted while taking the long hash, joined"""
+        return self._hashes.get("Tiers")
+
+    def LongHash(self):
+        if not "Long" in self._hashes and self.hashList._HasLadder(self.extension, self.useRawHashes):
+            # Carry on from wherever the tiers got to
+            ladder = self._Ladder()
+            self.hashList._AdvanceLadder(self._File(), ladder, self._TierCount())
+
+            self._hashes["Long"] = ladder.digest.finalize()
+            self._hashes["Tiers"] = b"".join(ladder.tiers) or None
+            self._ladder = None
+
+        if not "Long" in self._hashes:
+            segments = []
+            self._hashes["Long"] = self.hashList._LongHashSelector(self._File(), self.fileSize, self.relPath, self.extension, self.useRawHashes, self._Decoded(), segments)
+
+            # A single segment is the whole file, and already the long hash
+            if len(segments) > 1:
+                self._hashes["Segments"] = b"".join(segments)
+        return self._hashes["Long"]
+
+    def Segments(self):
+        """Leaf digests of a tree hashed long hash, joined, if it has been computed and spans several segments"""
+        return self._hashes.get("Segments")
+
+    def PerceptualHash(self):
+        if not "Perceptual" in self._hashes:
+            self._hashes["Perceptual"] = self.hashList._PerceptualHash(self._File(), self.fileSize, self.relPath, self.extension, self.useRawHashes, self.fullPath, self._Decoded())
+        return self._hashes["Perceptual"]
+
+    def Prime(self, useLongHash=True, usePerceptualHash=False, useShortHash=True):
+        """Compute hashes ahead of the lookup. Warnings are held back until FlushWarnings"""
+        self.hashList._CaptureWarnings(self.warnings)
+
+        try:
+            # Empty files never get hashed
+            if self.fileSize > 0:
+                if useShortHash:
+                    self.ShortHash()
+
+                if useLongHash:
+                    self.LongHash()
+
+                if usePerceptualHash:
+                    self.PerceptualHash()
+        finally:
+            self.hashList._CaptureWarnings(None)
+            self.Close()
+
+    def FlushWarnings(self):
+        for line in self.warnings:
+            print(line)
+
+        self.warnings = []
+
 
 class CHashList():
-    def __init__(self, path = None, additionalCapabilities = None):
-        self.hashList = []
+    def __init__(self, path = None, additionalCapabilities = None, inMemory = False):
+        """
+        Load the table at path, or create it. With no path, that's .!HashList here, emptied
+
+        InMemory keeps the table off disk entirely: nothing is opened, checkpointed or written
+        unless Write is given a path. For tools that only want the hashing
+        """
+        self.hashList = HashStore.CHashStore()
         self.hasWarnedOwnDirectory = False
         self.machineKey = EncryptionHelpers.LoadMachineKeys()
         self.unserialisedBytes = 0
         self.capabilities = []
-
-        self.perceptualHasher = hashers.PHash(hash_size=GLOBAL_HASH_SIZE, highfreq_factor=128, freq_shift=8)
+        self.pixelStripBytes = PIXEL_STRIP_BYTES
+        self.maxDecodedBytes = MAX_DECODED_BYTES
+        self.reader = Reader.CFileReader()
+        self.treeJobs = os.cpu_count() or 1
+        self._treePool = None
+        self._treePoolLock = threading.Lock()
+        self.warningSink = threading.local()
+
+        self.perceptualHasher = hashers.PHash(hash_size=GLOBAL_HASH_SIZE, highfreq_factor=GLOBAL_HIGHFREQ_FACTOR, freq_shift=8)
         #self.perceptualHasher = hashers.WaveletHash(hash_size=GLOBAL_HASH_SIZE)
 
         self.percVideoHasher = hashers.TMKL2(frames_per_second=0.25)#'keyframes')
         #self.percVideoHasher = hashers.FramewiseHasher(self.perceptualHasher, interframe_threshold=0.2)
 
-        # Gins
-        self.ginShortHash = {}
-        self.ginLongHash = {}
-        self.ginPerceptual = {}
-        self.ginTypes = {}
+        # Gins, by name. Each is built from the columns on first use unless the table had it saved
+        # Types and deferred entries come straight from the store's columns
+        self.gins = {}
+
+        # Forgotten entries stay in the list, unreachable, until the next write compacts them away
+        self.removedIndices = set()
+
+        # Files that resolved against the table without getting a row of their own (duplicates and
+        # empty files), by path: (stat key, (path, size, short hash, long hash) of the entry they matched, or None)
+        # Lets an incremental scan skip them too
+        self.resolvedPaths = {}
+
+        # Journal state (see Checkpoint). Rows, removals and hashes up to here are already on disk
+        self.snapshotId = self._SnapshotId(b"")
+        self.journalRows = 0
+        self.journalRemoved = set()
+        self.journalHashed = set()
+        self.journalResolved = {}
+        self.journalLength = 0
+        self.journalStale = False
+
+        # Set while pruning alongside a walk (see BeginPrune)
+        self.pruneRoot = None
+        self.visitedPaths = None
+        self.presentPaths = None
+        self.missingPaths = None
 
         #LoadHashes
-        if path:
+        if inMemory:
+            self.storeName = None
+            self.capabilities = SUPPORTED_CAPABILITIES + (additionalCapabilities or [])
+        elif path:
             if os.path.isdir(path):
                 raise ValueError("Path is a directory, not a file")
 
@@ -99,8 +503,10 @@ class CHashList():
                     pass
 
                 # Populate the capabilities
-                self.capabilities = SUPPORTED_CAPABILITIES
-                self.capabilities += additionalCapabilities
+                self.capabilities = SUPPORTED_CAPABILITIES + (additionalCapabilities or [])
+
+            # Pick up any checkpoints made since the table was last written
+            self._ReplayJournal()
                 
         else:
             self.storeName = ".!HashList"
@@ -108,33 +514,109 @@ class CHashList():
             with open(self.storeName, "wb+") as nf:
                 pass
 
+            # The table was just emptied, so its journal is meaningless
+            if os.path.exists(self._JournalPath()):
+                os.remove(self._JournalPath())
+
         
             # Populate the capabilities
-            self.capabilities = SUPPORTED_CAPABILITIES
-            self.capabilities += additionalCapabilities
+            self.capabilities = SUPPORTED_CAPABILITIES + (additionalCapabilities or [])
 
 
-    def _AddToGin(self, gin, key, value):
-        """Silly Helper function to avoid a bit of duplication"""
-        if key in gin:
-            gin[key].append(value)
+    def _Warn(self, message):
+        """Print, unless this thread is capturing warnings for an element"""
+        lines = getattr(self.warningSink, "lines", None)
+
+        if lines is None:
+            print(message)
         else:
-            gin[key] = [value]
+            lines.append(message)
 
-    def _GenerateGINs(self):
+    def _CaptureWarnings(self, lines):
+        self.warningSink.lines = lines
+
+    def _PerceptualKey(self, ph):
+        return HashStore.KeyOf(ph[0][:HASH_CLIP])
+
+    def _PerceptualBits(self, ph):
+        """Raw bits of a perceptual hash, or None if it isn't a hash string we can decode"""
+        try:
+            return base64.b64decode(ph[0], validate=True)
+        except (TypeError, ValueError):
+            return None
+
+    def _IsNearIndexed(self, extension, ph):
+        return ph is not None and extension.lower() in PIL_supportedImageTypes
+
+    def _NewGin(self, name):
+        if name == "PerceptualNear":
+            return HashStore.CHammingIndex(PERCEPTUAL_HASH_BYTES, PERCEPTUAL_NEAR_RADIUS)
+        return HashStore.CKeyIndex()
+
+    def _GenerateGIN(self, name):
         # Generate
-        print("[INFO] Generate Inverted Indices")
+        print("[INFO] Generate Inverted Index ({})".format(name))
+
+        # Rebuilt from whole columns, rather than entry by entry
+        store = self.hashList
+        gin = self._NewGin(name)
+
+        if name == "Size":
+            gin.Build(store.Sizes().astype(numpy.uint64), numpy.arange(len(store), dtype=numpy.int64))
+        elif name == "Short":
+            gin.Build(*store.HashKeys(HashStore.FLAG_SHORT))
+        elif name == "Long":
+            gin.Build(*store.HashKeys(HashStore.FLAG_LONG))
+        elif name == "Paths":
+            gin.Build(*store.PathKeys())
+        elif name == "Perceptual":
+            percRows = sorted(store.perceptual)
+            gin.Build([self._PerceptualKey(store.perceptual[row]) for row in percRows], percRows)
+        elif name == "PerceptualNear":
+            nearRows = [row for row in sorted(store.perceptual) if self._IsNearIndexed(store.Extension(row), store.perceptual[row])]
+            gin.Build([self._PerceptualBits(store.perceptual[row]) for row in nearRows], nearRows)
+        else:
+            raise ValueError("No inverted index called {}".format(name))
 
-        # NUKE
-        self.ginShortHash = {}
-        self.ginLongHash = {}
-        self.ginPerceptual = {}
-        self.ginTypes = {}
+        return gin
 
-        # For all hashes
-        for idx in range(len(self.hashList)):
-            self._AddToGINs(idx)
+    def _Gin(self, name):
+        if not name in self.gins:
+            self.gins[name] = self._GenerateGIN(name)
+        return self.gins[name]
+
+    @property
+    def ginSize(self):
+        return self._Gin("Size")
+
+    @property
+    def ginShortHash(self):
+        return self._Gin("Short")
+
+    @property
+    def ginLongHash(self):
+        return self._Gin("Long")
+
+    @property
+    def ginPaths(self):
+        return self._Gin("Paths")
 
+    @property
+    def ginPerceptual(self):
+        return self._Gin("Perceptual")
+
+    @property
+    def ginPerceptualNear(self):
+        return self._Gin("PerceptualNear")
+
+    def _GenerateGINs(self):
+        """Drop every index. Each is rebuilt when next used"""
+        self.gins = {}
+
+    def _AddToGin(self, name, key, value):
+        # Indices that aren't built yet will pick the row up from the columns
+        if name in self.gins:
+            self.gins[name].Add(key, value)
 
     def _AddToGINs(self, value):
         if not len(self.hashList) > value:
@@ -142,53 +624,92 @@ class CHashList():
             return
         (sz, shs, lhs, nm, ph) = self.hashList[value]
 
+        self._AddToGin("Size", sz, value)
+        self._AddToGin("Paths", HashStore.KeyOf(nm[0]), value)
+
         # Add to Short GIN
         if shs is not None:
-            self._AddToGin(self.ginShortHash, shs, value)
+            self._AddToGin("Short", HashStore.KeyOf(shs), value)
         
         if lhs is not None:
-            self._AddToGin(self.ginLongHash, lhs, value)
+            self._AddToGin("Long", HashStore.KeyOf(lhs), value)
 
         if ph is not None:
-            hashAsString = ph[0][:HASH_CLIP]
-            self._AddToGin(self.ginPerceptual, hashAsString, value)
+            self._AddToGin("Perceptual", self._PerceptualKey(ph), value)
 
-        # Handle types
-        if nm[1].lower() in PIL_supportedImageTypes:
-            self._AddToGin(self.ginTypes, "Image", value)
-        elif nm[1].lower() in PERC_supportedVideoTypes:
-            self._AddToGin(self.ginTypes, "Video", value)
+        # Images, for near duplicate searches
+        if self._IsNearIndexed(nm[1], ph):
+            self._AddToGin("PerceptualNear", self._PerceptualBits(ph), value)
+
+    def _PackGINs(self):
+        """Every index, built if need be, for saving alongside the table"""
+        indices = {name: self._Gin(name).Pack() for name in GIN_NAMES}
+        return {"Version": HashStore.INDEX_LAYOUT_VERSION, "Rows": len(self.hashList), "Indices": indices}
+
+    def _UnpackGINs(self, packed):
+        """Use saved indices if they match the table. Otherwise they're built as needed"""
+        self._GenerateGINs()
+
+        if packed is None or packed.get("Version") != HashStore.INDEX_LAYOUT_VERSION or packed.get("Rows") != len(self.hashList):
+            return
+
+        for name, gin in packed["Indices"].items():
+            if name in GIN_NAMES:
+                index = self._NewGin(name)
+                if index.Unpack(gin):
+                    self.gins[name] = index
 
 
     def _LoadHashList(self, path, fromCheckpoint:bool=False):
         with open(path, "rb+") as f:
-            pickled = EncryptionHelpers.Decrypt(f.read(), self.machineKey)
+            data = f.read()
+            pickled = EncryptionHelpers.Decrypt(data, self.machineKey)
+            self.snapshotId = self._SnapshotId(data)
             
             # Handle having an older file version
             temp = pickle.loads(pickled)
+            statCache = {}
+            indices = None
             if len(temp) == 1:
                 # Old version, skip doing versioning things entirely
                 # We also definitely have no extended behaviour
-                self.hashList = pickle.loads(pickled)
+                entries = pickle.loads(pickled)
             elif len(temp) == 2:
-                vn, self.hashList = temp
+                vn, entries = temp
 
                 # Handle versioning
                 if vn > 1:
                     self.capabilities = []
             elif len(temp) == 3:
-                vn, caps, self.hashList = temp
+                vn, caps, entries = temp
 
                 if vn >= 3:
                     self.capabilities = caps
+            elif len(temp) == 4:
+                vn, self.capabilities, entries, sections = temp
+
+                # Version 4 kept stat data apart, by path
+                statCache = sections.get("Stat", {})
+                indices = sections.get("Index")
+                self.resolvedPaths = dict(sections.get("Resolved", {}))
 
             else:
                 # Excuse me?
                 raise RuntimeError("Hashlist failed to load. This may be due to an outdated version")
+
+            if isinstance(entries, dict):
+                self.hashList = HashStore.CHashStore.FromPacked(entries)
+            else:
+                self.hashList = HashStore.CHashStore.FromEntries(entries)
             
             print("[INFO] Loaded {} References {}".format(len(self.hashList), "from checkpoint" if fromCheckpoint else ""))
 
-            self._GenerateGINs()
+            self._UnpackGINs(indices)
+
+            for relPath, statKey in statCache.items():
+                rows = self._RowsAtPath(relPath)
+                if rows and self.hashList.Size(rows[-1]) == statKey[2]:
+                    self.hashList.SetStat(rows[-1], statKey)
 
 
     def _SanitisePath(self, path):
@@ -200,72 +721,299 @@ class CHashList():
     # def AddElement(self, sizeBytes, fhash, name):
     #     self.hashList.append((sizeBytes, fhash, name))
 
+    def _RowsAtPath(self, saneRelPath):
+        """Live rows for saneRelPath, oldest first"""
+        return [idx for idx in self.ginPaths.Find(HashStore.KeyOf(saneRelPath)) if not idx in self.removedIndices and self.hashList.Path(idx) == saneRelPath]
+
     def CheckElementAtPath(self, name, szBytes):
-        for sz, shs, lhs, nm, ph in self.hashList:
-            if name[0] == nm[0]:
-                if sz == szBytes:
-                    return True
-                else:
-                    print("Found file, but it's size has changed!")
-                    break
+        for idx in self._RowsAtPath(self._SanitisePath(name[0])):
+            if self.hashList.Size(idx) == szBytes:
+                return True
+            else:
+                print("Found file, but it's size has changed!")
+                break
         return False
 
+    def _StatKey(self, stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def IsElementUnchanged(self, relPath, stat):
+        """True when the file at relPath is in the table and looks the same as when it was hashed"""
+        saneRelPath = self._SanitisePath(relPath)
+
+        # The newest entry with stat data is the one that counts
+        stats = [self.hashList.Stat(idx) for idx in self._RowsAtPath(saneRelPath)]
+        stats = [x for x in stats if x is not None]
+
+        if not stats:
+            return self._IsResolvedUnchanged(saneRelPath, stat)
+
+        if stats[-1] != self._StatKey(stat):
+            return False
+
+        return self.CheckElementAtPath((saneRelPath, None), stat.st_size)
+
+    def _IsResolvedUnchanged(self, saneRelPath, stat):
+        """A duplicate or empty file that looks the same, and whose match is still in the table"""
+        resolved = self.resolvedPaths.get(saneRelPath)
+        if resolved is None or resolved[0] != self._StatKey(stat):
+            return False
+
+        match = resolved[1]
+        if match is None:
+            return True
+
+        # The entry may have been replaced since, by a modified file
+        return any(self._MatchKey(idx) == match and self._IsEntryLive(idx) for idx in self._RowsAtPath(match[0]))
+
+    def _MatchKey(self, idx):
+        return (self.hashList.Path(idx), self.hashList.Size(idx), self.hashList.ShortHash(idx), self.hashList.LongHash(idx))
+
+    def RecordResolved(self, relPath, stat, idx):
+        """Note that the file at relPath, as stat'ed, is a duplicate of the entry at idx (None if it's empty)"""
+        saneRelPath = self._SanitisePath(relPath)
+
+        # A rescan finds every file at its own entry. That row's stat already covers it
+        if idx is not None and self.hashList.Path(idx) == saneRelPath:
+            return
+
+        self.resolvedPaths[saneRelPath] = (self._StatKey(stat), self._MatchKey(idx) if idx is not None else None)
+        self.journalResolved[saneRelPath] = self.resolvedPaths[saneRelPath]
+
+    def ForgetElement(self, relPath):
+        """Drop every entry for relPath, so a modified file can be hashed and added again"""
+        for idx in self._RowsAtPath(self._SanitisePath(relPath)):
+            self.removedIndices.add(idx)
+
+        self.resolvedPaths.pop(self._SanitisePath(relPath), None)
+
+    def SegmentsAtPath(self, relPath):
+        """Leaf digests of the newest entry for relPath, if it was tree hashed in several segments"""
+        rows = self._RowsAtPath(self._SanitisePath(relPath))
+        return self.hashList.Segments(rows[-1]) if rows else None
+
+    def ChangedSegments(self, oldSegments, newSegments):
+        """Indices of the segments that differ between two sets of leaf digests. Ones only one side has count too"""
+        size = HashStore.DIGEST_SIZE
+        count = max(len(oldSegments), len(newSegments)) // size
+
+        return [i for i in range(count) if oldSegments[i * size:(i + 1) * size] != newSegments[i * size:(i + 1) * size]]
+
+    def _CompactEntries(self):
+        """Remove forgotten entries for good. Indices shift, and the GINs follow them"""
+        if not self.removedIndices:
+            return
+
+        newRows = self.hashList.Compact(self.removedIndices)
+        self.removedIndices = set()
+
+        # Rows have moved, so only a full write can describe the table now
+        self.journalStale = True
+
+        for gin in self.gins.values():
+            gin.Remap(newRows)
+
     def Prune(self, path, dry_run=False, silent=True):
-        # Prune the paths
-        # While because immediately deleted paths will free an index
-        dirty = False
+        """Remove every entry whose file no longer exists under path"""
+        self.BeginPrune(path)
+        self.FinishPrune(dry_run, silent)
 
-        idx = 0
-        while idx < len(self.hashList): 
+    def BeginPrune(self, path):
+        """
+        Prune alongside a walk of path instead of checking every entry up front
 
-            sz, shs, lhs, nm, ph = self.hashList[idx]
-            fullPath = os.path.join(path, nm[0])
+        Call MarkVisited for each file the walk finds and FinishPrune once it's done.
+        Only entries the walk never reached are checked on disk
+        """
+        self._CompactEntries()
 
-            if not os.path.exists(fullPath):
-                if not silent:
-                    print("File {} not found, pruning entry.".format(nm))
+        self.pruneRoot = path
+        self.visitedPaths = set()
+        self.presentPaths = set()
+        self.missingPaths = set()
 
-                if not dry_run:
-                    # We free an index here, so we don't increment idx as it now refers to the old idx+1 anyway
-                    del self.hashList[idx]
-                    dirty = True
-                    continue
-            
-            idx += 1
+    def MarkVisited(self, relPath):
+        if self.visitedPaths is not None:
+            self.visitedPaths.add(self._SanitisePath(relPath))
+
+    def _IsEntryLive(self, idx):
+        """Does the entry's file still exist? Always true unless a prune is under way"""
+        if self.visitedPaths is None:
+            return True
 
-        if dirty:
-            self._GenerateGINs()
+        nm = self.hashList.Path(idx)
+
+        if nm in self.visitedPaths or nm in self.presentPaths:
+            return True
+
+        if nm in self.missingPaths:
+            return False
+
+        # Not walked (yet), so look once and remember
+        if os.path.exists(os.path.join(self.pruneRoot, nm)):
+            self.presentPaths.add(nm)
+            return True
+
+        self.missingPaths.add(nm)
+        return False
+
+    def FinishPrune(self, dry_run=False, silent=True):
+        """Drop the entries whose files are gone, with a single compaction"""
+        if self.visitedPaths is None:
+            return
+
+        for idx in range(len(self.hashList)):
+            if idx in self.removedIndices or self._IsEntryLive(idx):
+                continue
+
+            nm = (self.hashList.Path(idx), self.hashList.Extension(idx))
+
+            if not silent:
+                print("File {} not found, pruning entry.".format(nm))
+
+            if not dry_run:
+                self.removedIndices.add(idx)
+
+        if not dry_run:
+            for relPath in list(self.resolvedPaths):
+                if not relPath in self.visitedPaths and not os.path.exists(os.path.join(self.pruneRoot, relPath)):
+                    del self.resolvedPaths[relPath]
+
+        self.visitedPaths = None
+        self.presentPaths = None
+        self.missingPaths = None
+
+        self._CompactEntries()
 
     def _GetHashProvider(self):
         if EXT_SHA512 in self.capabilities:
             return hashes.SHA512_256()
         return hashes.SHA3_256()
 
+    def _NewDigest(self):
+        """An empty digest from the table's provider. BLAKE2 beats the others, then SHA512"""
+        if EXT_BLAKE2b in self.capabilities:
+            return CHashlibDigest(hashlib.blake2b(digest_size=HashStore.DIGEST_SIZE))
+
+        if EXT_BLAKE2s in self.capabilities:
+            return CHashlibDigest(hashlib.blake2s(digest_size=HashStore.DIGEST_SIZE))
+
+        return hashes.Hash(self._GetHashProvider(), backend=default_backend())
+
     def _GetHash(self, data):
-        digest = hashes.Hash(self._GetHashProvider(), backend=default_backend())
+        digest = self._NewDigest()
 
         digest.update(data)
 
         return digest.finalize()
 
-    def _ChunksOf(self, fileObj):
-        while True:
-            chunk = fileObj.read(1024 * 1024 * 64)
+    # Using 64MiB of ram per thread, surely people have this much
+    def _GetLongHash(self, fileObj, segments=None):
+        if EXT_TreeLongHash in self.capabilities:
+            return self._GetTreeHash(fileObj, segments)
+
+        digest = self._NewDigest()
+
+        for chunk in self.reader.Chunks(fileObj):
+            digest.update(chunk)
+        fileObj.seek(0)
+
+        return digest.finalize()
+
+    def _HasLadder(self, fileExtension, useRaw):
+        """Whether the long hash is a plain digest of the file, so prefixes of it can be compared first"""
+        if EXT_TreeLongHash in self.capabilities:
+            return False
+
+        return useRaw or not fileExtension.lower() in PIL_supportedImageTypes
+
+    def _AdvanceLadder(self, fileObj, ladder, tierCount, end=None):
+        """Read on from where the ladder stopped to end, or the end of the file, noting the first tierCount tiers"""
+        while not ladder.finished and (end is None or ladder.offset < end):
+            stop = end
+            if len(ladder.tiers) < tierCount:
+                nextTier = TIER_SIZES[len(ladder.tiers)]
+                stop = nextTier if stop is None else min(stop, nextTier)
+
+            if stop is None:
+                # No tiers left to note. Chunks maps large files, as _GetLongHash would
+                for chunk in self.reader.Chunks(fileObj, ladder.offset):
+                    ladder.digest.update(chunk)
+                    ladder.offset += len(chunk)
 
-            if not chunk:
+                ladder.finished = True
                 break
-            else:
-                yield chunk
 
-    # Using 64MiB of ram, surely people have this much
-    def _GetLongHash(self, fileObj):
-        digest = hashes.Hash(self._GetHashProvider(), backend=default_backend())
+            size = stop - ladder.offset
 
-        fileObj.seek(0)
-        for chunk in self._ChunksOf(fileObj):
+            read = 0
+            for chunk in self.reader.Range(fileObj, ladder.offset, size):
+                ladder.digest.update(chunk)
+                read += len(chunk)
+
+            ladder.offset += read
+            ladder.finished = read < size
+
+            if len(ladder.tiers) < tierCount and ladder.offset == TIER_SIZES[len(ladder.tiers)]:
+                ladder.tiers.append(ladder.digest.copy().finalize())
+
+    def _TreePool(self):
+        # Shared by every file, so scanning threads don't each start their own
+        with self._treePoolLock:
+            if self._treePool is None:
+                self._treePool = ThreadPoolExecutor(max_workers=self.treeJobs)
+            return self._treePool
+
+    def _GetSegmentHash(self, fileObj, offset):
+        digest = self._NewDigest()
+        digest.update(b"\x00")
+
+        for chunk in self.reader.Range(fileObj, offset, TREE_SEGMENT_SIZE):
             digest.update(chunk)
+
+        return digest.finalize()
+
+    def _GetTreeHash(self, fileObj, segments=None):
+        """
+        Merkle root of the file's segments (see TREE_SEGMENT_SIZE), hashed in parallel
+
+        Leaf digests are appended to segments, when given, so changes can later be placed
+        """
+        fileSize = fileObj.seek(0, os.SEEK_END)
         fileObj.seek(0)
 
+        offsets = range(0, max(fileSize, 1), TREE_SEGMENT_SIZE)
+
+        if len(offsets) > 1 and self.treeJobs > 1:
+            level = list(self._TreePool().map(lambda offset: self._GetSegmentHash(fileObj, offset), offsets))
+        else:
+            level = [self._GetSegmentHash(fileObj, offset) for offset in offsets]
+
+        if segments is not None:
+            segments.extend(level)
+
+        while len(level) > 1:
+            parents = []
+
+            for i in range(0, len(level) - 1, 2):
+                digest = self._NewDigest()
+                digest.update(b"\x01" + level[i] + level[i + 1])
+                parents.append(digest.finalize())
+
+            if len(level) % 2:
+                parents.append(level[-1])
+
+            level = parents
+
+        return level[0]
+
+    def _GetBlocksHash(self, fileObj, offsets, blockSize):
+        # Each block overwrites the last in the reader's buffer, so digest as we go
+        digest = self._NewDigest()
+
+        for offset in offsets:
+            digest.update(self.reader.Block(fileObj, offset, blockSize))
+
         return digest.finalize()
 
     def _GetShortHash(self, fileObj, fileSize):
@@ -280,18 +1028,11 @@ class CHashList():
                 # Just read the entire file and reset seek
                 return self._GetLongHash(fileObj)
             
-            FirstBlock = fileObj.read(localBlockSize)
-
             # Compute middle offset
             MidPoint = fileSize // 2
             MidBlockPoint = MidPoint - (localBlockSize)
-            fileObj.seek(MidBlockPoint, 0)
-            MidBlock = fileObj.read(localBlockSize)
-
-            fileObj.seek(-localBlockSize, 2)
-            LastBlock = fileObj.read(localBlockSize)
 
-            sHash = self._GetHash(FirstBlock + MidBlock + LastBlock)
+            sHash = self._GetBlocksHash(fileObj, [0, MidBlockPoint, -localBlockSize], localBlockSize)
 
             # Reset seek
             fileObj.seek(0)
@@ -303,43 +1044,100 @@ class CHashList():
                 # Just read the entire file and reset seek
                 return self._GetLongHash(fileObj)
 
-            firstBlock = fileObj.read(localBlockSize)
-
-            # Seek end
-            fileObj.seek(-localBlockSize, 2)
-            lastBlock = fileObj.read(localBlockSize)
-
-            sHash = self._GetHash(firstBlock + lastBlock)
+            # First and last blocks
+            sHash = self._GetBlocksHash(fileObj, [0, -localBlockSize], localBlockSize)
 
             # Reset seek
             fileObj.seek(0) 
 
             return sHash
 
-    def _PILHash(self, fileObj, limit=None):
-        img = Image.open(fileObj)
-        imgData = numpy.array(img)
-        return self._GetHash(imgData[0:limit])
+    def _PILHash(self, decoded, limit=None):
+        """
+        Hash the first limit rows of pixels (all of them by default), one strip at a time
+
+        The digest is that of the whole pixel array, but only one strip is ever copied out
+        of the decoded image, however large it is. PIL holds the decoded image itself, which
+        CDecodedImage can cap at maxDecodedBytes
+        """
+        image = decoded.Image()
+        width, height = image.size
+        rows = height if limit is None else min(limit, height)
 
-    def _PerceptualHash(self, fileObj, fileSize, path, fileExtension, useRaw, fullFilePath = None):
+        rowBytes = max(1, width * len(image.getbands()))
+        stripRows = max(1, self.pixelStripBytes // rowBytes)
+
+        digest = self._NewDigest()
+
+        for top in range(0, rows, stripRows):
+            strip = numpy.asarray(image.crop((0, top, width, min(top + stripRows, rows))))
+            digest.update(memoryview(strip))
+
+        return digest.finalize()
+
+    def _PayloadHash(self, decoded, limit=None):
+        """Hash the compressed image data. With a limit, only its first and last limit bytes, as _GetShortHash does"""
+        pieces = decoded.Payload()
+        total = sum(len(x) for x in pieces)
+
+        if limit is None or total <= limit * 2:
+            ranges = [(0, total)]
+        else:
+            ranges = [(0, limit), (total - limit, total)]
+
+        digest = self._NewDigest()
+
+        for start, end in ranges:
+            for piece in Containers.Slice(pieces, start, end):
+                digest.update(piece)
+
+        return digest.finalize()
+
+    def _ImageHash(self, decoded, fileExtension, limit=None):
+        """Hash what the image holds rather than the file. The compressed payload if the table allows, else the pixels"""
+        if EXT_ContainerPayloadHash in self.capabilities and Containers.IsPayloadType(fileExtension):
+            try:
+                return self._PayloadHash(decoded, limit)
+            except ValueError:
+                # Doesn't parse. Decoding may still cope
+                pass
+
+        return self._PILHash(decoded, limit)
+
+    def _WarnTooLarge(self, decoded, path, error):
+        # Once per image, however many of its hashes give up
+        if not decoded.reportedTooLarge:
+            self._Warn("[WARN] Image {} is too large to decode. It's hashed as a file, with no perceptual hash. {}".format(path, error))
+            decoded.reportedTooLarge = True
+
+    def _PerceptualHash(self, fileObj, fileSize, path, fileExtension, useRaw, fullFilePath = None, decoded = None):
         """Implements a perceptual hash"""
+        if decoded is None:
+            decoded = CDecodedImage(fileObj, self.maxDecodedBytes)
 
         try:
             if fileExtension.lower() in PIL_supportedImageTypes:
                 # Hash
-                img = Image.open(fileObj)
+                if EXT_ReducedPerceptualDecode in self.capabilities:
+                    side = GLOBAL_HASH_SIZE * GLOBAL_HIGHFREQ_FACTOR
+                    img = decoded.Reduced((side, side))
+                else:
+                    img = decoded.Image()
                 #perceptual = imagehash.phash(img, hash_size=GLOBAL_HASH_SIZE, highfreq_factor=256)
                 
                 perceptual = self.perceptualHasher.compute(img)#, "hex")
 
-                # Yes, return as type!
-                return (perceptual, img.width, img.height)
+                # Yes, return as type! Sizes are the file's, not the decode's
+                width, height = decoded.Size()
+                return (perceptual, width, height)
             elif fileExtension.lower() in PERC_supportedVideoTypes and fullFilePath is not None:
                 tempFP = fullFilePath.decode()
                 perceptual = self.percVideoHasher.compute(tempFP, max_size=120, max_duration=60)
                 return (perceptual, 0, 0)
+        except CImageTooLargeError as e:
+            self._WarnTooLarge(decoded, path, e)
         except Exception as _:
-            print("[WARN] Possible Bad File: {} ({})".format(path, _))
+            self._Warn("[WARN] Possible Bad File: {} ({})".format(path, _))
         except KeyboardInterrupt as kbi:
             raise kbi
 
@@ -357,47 +1155,85 @@ class CHashList():
 
         return 4096
 
-    def _ShortHashSelector(self, fileObj, fileSize, path, fileExtension, useRaw):
+    def _ShortHashSelector(self, fileObj, fileSize, path, fileExtension, useRaw, decoded = None):
         if useRaw:
             return self._GetShortHash(fileObj, fileSize)
 
+        if decoded is None:
+            decoded = CDecodedImage(fileObj, self.maxDecodedBytes)
+
         # Use Selector
         try:
             if fileExtension.lower() in PIL_supportedImageTypes:
-                return self._PILHash(fileObj, self._GetShortHashBlockSize())
+                return self._ImageHash(decoded, fileExtension, self._GetShortHashBlockSize())
+        except CImageTooLargeError as e:
+            self._WarnTooLarge(decoded, path, e)
         except Exception as _:
-            print("[WARN] Possible Bad File: {}".format(path))
+            self._Warn("[WARN] Possible Bad File: {}".format(path))
         except KeyboardInterrupt as kbi:
             raise kbi
 
         return self._GetShortHash(fileObj, fileSize)
 
-    def _LongHashSelector(self, fileObj, fileSize, path, fileExtension, useRaw):
+    def _LongHashSelector(self, fileObj, fileSize, path, fileExtension, useRaw, decoded = None, segments = None):
         if useRaw:
-            return self._GetLongHash(fileObj)
+            return self._GetLongHash(fileObj, segments)
+
+        if decoded is None:
+            decoded = CDecodedImage(fileObj, self.maxDecodedBytes)
 
         try:
             if fileExtension.lower() in PIL_supportedImageTypes:
-                return self._PILHash(fileObj)
+                return self._ImageHash(decoded, fileExtension)
+        except CImageTooLargeError as e:
+            self._WarnTooLarge(decoded, path, e)
         except Exception as _:
-            print("[WARN] Possible Bad File: {}".format(path))
+            self._Warn("[WARN] Possible Bad File: {}".format(path))
         except KeyboardInterrupt as kbi:
             raise kbi
 
-        return self._GetLongHash(fileObj)
+        return self._GetLongHash(fileObj, segments)
 
 
+    def ComparePerceptualSizes(self, hPerceptualHash, ph):
+        """1 if the first image is larger in both dimensions than the second, -1 if it's smaller, 0 if neither (cropped?)"""
+        score = -1
+        if hPerceptualHash[1] > ph[1]:
+            score += 1
+        if hPerceptualHash[2] > ph[2]:
+            score += 1
+
+        return score
+
+    def GetPerceptualHashes(self):
+        """(rows, bits) for every image with a perceptual hash. Bits is a matrix of the packed hashes, one row each"""
+        rows = []
+        bits = []
+
+        for row in sorted(self.hashList.perceptual):
+            if row in self.removedIndices:
+                continue
+
+            ph = self.hashList.perceptual[row]
+            if not self._IsNearIndexed(self.hashList.Extension(row), ph):
+                continue
+
+            hashBits = self._PerceptualBits(ph)
+            if hashBits is None or len(hashBits) != PERCEPTUAL_HASH_BYTES:
+                continue
+
+            rows.append(row)
+            bits.append(hashBits)
+
+        return rows, numpy.frombuffer(b"".join(bits), dtype=numpy.uint8).reshape(-1, PERCEPTUAL_HASH_BYTES)
+
     def _PerceptualHashScore(self, hPerceptualHash, ph, name, nm, delta):
 
         # Return early. It's literally the same file
         if self._SanitisePath(name[0]) == nm[0]:
             return False
 
-        score = -1
-        if hPerceptualHash[1] > ph[1]:
-            score += 1
-        if hPerceptualHash[2] > ph[2]:
-            score += 1
+        score = self.ComparePerceptualSizes(hPerceptualHash, ph)
 
         if score > 0:
             print("[COLLISION][PH][LARGER] File {} ({}x{}) collided with {} ({}x{}) at {:02%}".format(self._SanitisePath(name[0]), hPerceptualHash[1], hPerceptualHash[2], nm[0], ph[1], ph[2], 1 - numpy.max(delta) ) )                            
@@ -424,7 +1260,8 @@ class CHashList():
 
     # Refactor later!
     # We want to filter info about hard or soft collisions upwards (IE, we want information about *why* a collision occured)
-    def _DoesHashCollide(self, iFileSize, name, hShortHash, hLongHash, silent, hPerceptualHash=None):
+    def _FindCollision(self, iFileSize, name, hShortHash, hLongHash, silent, hPerceptualHash=None):
+        """Index of the entry these hashes collide with, or None"""
         # Check here. Python can be slow with string cmps
         usingPerceptualHash = EXT_PerceptualHash in self.capabilities and not hPerceptualHash is None
 
@@ -433,22 +1270,22 @@ class CHashList():
 
         indices = []
         if usingPerceptualHash:
-            temp = hPerceptualHash[0][:HASH_CLIP]
-            if temp in self.ginPerceptual:
-                indices = self.ginPerceptual[temp]
-                mode = "Perc"
+            indices = self.ginPerceptual.Find(self._PerceptualKey(hPerceptualHash))
+            mode = "Perc"
         elif hLongHash is not None:
-            if hLongHash in self.ginLongHash:
-                indices = self.ginLongHash[hLongHash]
-                mode = "Long"
+            indices = self.ginLongHash.Find(HashStore.KeyOf(hLongHash))
+            mode = "Long"
         elif hShortHash is not None:
-            if hShortHash in self.ginShortHash:
-                indices = self.ginShortHash[hShortHash]
-                mode = "Short"
+            indices = self.ginShortHash.Find(HashStore.KeyOf(hShortHash))
+            mode = "Short"
 
         if len(indices) > 0:
             #print("[INFO] FAST PATH: {}".format(mode))
             for idx in indices:
+                # Entries whose files have gone can't be collided with
+                if idx in self.removedIndices or not self._IsEntryLive(idx):
+                    continue
+
                 # Check Collision Mode
                 sz, shs, lhs, nm, ph = self.hashList[idx]
 
@@ -463,7 +1300,7 @@ class CHashList():
                         if not silent:
                             print("[COLLISION] File {} collided with {}".format(self._SanitisePath(name[0]), nm[0]))
 
-                    return True
+                    return idx
 
                 elif usingPerceptualHash:
                     if ph[0] == hPerceptualHash[0]:
@@ -471,7 +1308,7 @@ class CHashList():
                         # If a hash collides, but we are larger: don't return the collision
                         # Instead. Warn and bin the old entry
 
-                        return self._PerceptualHashScore(hPerceptualHash, ph, name, nm, [0])   
+                        return idx if self._PerceptualHashScore(hPerceptualHash, ph, name, nm, [0]) else None
 
                         score = -1
                         if hPerceptualHash[1] > ph[1]:
@@ -488,27 +1325,27 @@ class CHashList():
                             # Prune the ph entry
                             #del self.hashList[idx]
                             #self._GenerateGINs()
-                            return False
+                            return None
                         elif score == 0:
                             # Cropped?
                             # Warn and ret
                             if not silent:
                                 print("[WARN][PH] Found potentially cropped image ({}): allowing both.".format(name), file=sys.stderr)
-                            return False
+                            return None
                         else:
                             if not silent:
                                 print("[COLLISION][PH] File {} ({}x{}) collided with {} ({}x{})".format(self._SanitisePath(name[0]), hPerceptualHash[1], hPerceptualHash[2], nm[0], ph[1], ph[2] ) )
                             # TEMP
-                            return False
+                            return None
                     elif name[1].lower() in PERC_supportedVideoTypes:
                         delta = self.percVideoHasher.compute_distance(ph[0], hPerceptualHash[0])
                         if delta < GLOBAL_LOG_THRESHOLD and not silent:
-                            return self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta)   
+                            return idx if self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta) else None
                             #print("[COLLISION][PH] VMatched {} vs {} at {:02%}".format(name[0], nm[0], 1 - numpy.max(delta)))
                     elif name[1].lower() in PIL_supportedImageTypes:
                         delta = self.perceptualHasher.compute_distance(ph[0], hPerceptualHash[0])
                         if delta < GLOBAL_LOG_THRESHOLD and not silent:
-                            return self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta)  
+                            return idx if self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta) else None
                             #print("[COLLISION][PH] IMatched {} vs {} at {:02%}".format(name[0], nm[0], 1 - numpy.max(delta)))
 
         else:
@@ -517,19 +1354,21 @@ class CHashList():
                 # Use a fallback GIN. We aren't going to go full fallback, that'd be slow
                 
                 if name[1].lower() in PIL_supportedImageTypes:
-                    if "Image" in self.ginTypes:
-                        indices = self.ginTypes["Image"]
-                        mode = "Image Fallback"
+                    # Only images close enough in Hamming space to pass the threshold below
+                    indices = self.ginPerceptualNear.Find(self._PerceptualBits(hPerceptualHash))
+                    mode = "Image Fallback"
                 elif name[1].lower() in PERC_supportedVideoTypes: 
-                    if "Video" in self.ginTypes:
-                        indices = self.ginTypes["Video"]
-                        mode = "Video Fallback"
+                    indices = self.hashList.RowsWithExtensions(PERC_supportedVideoTypes)
+                    mode = "Video Fallback"
 
                 if not len(indices) > 0:
-                    return False
+                    return None
 
                 #print("[INFO] Fallback: {}".format(mode))
                 for idx in indices:
+                    if idx in self.removedIndices or not self._IsEntryLive(idx):
+                        continue
+
                     (sz, shs, lhs, nm, ph) = self.hashList[idx]
                     # ## Size has to match for a *hard* collision
                     # if sz == iFileSize:
@@ -561,10 +1400,12 @@ class CHashList():
 
                         if delta < GLOBAL_LOG_THRESHOLD and not silent:
                             #print("[COLLISION][PH] File {} ({}x{}) collided with {} ({}x{}) at {:02%}".format(self._SanitisePath(name[0]), hPerceptualHash[1], hPerceptualHash[2], nm[0], ph[1], ph[2], 1 - numpy.max(delta) ) )                            
-                            return self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta)                          
+                            return idx if self._PerceptualHashScore(hPerceptualHash, ph, name, nm, delta) else None
                 
-        return False
+        return None
 
+    def _DoesHashCollide(self, iFileSize, name, hShortHash, hLongHash, silent, hPerceptualHash=None):
+        return self._FindCollision(iFileSize, name, hShortHash, hLongHash, silent, hPerceptualHash) is not None
 
 
     def _DoesLongHashCollide(self, iFileSize, name, hLongHash, silent):
@@ -576,54 +1417,244 @@ class CHashList():
     def _DoesPerceptualHashCollide(self, iFileSize, name, hPerceptualHash, silent):
         return self._DoesHashCollide(iFileSize, name, None, None, silent, hPerceptualHash)
     
-    def IsElementKnown(self, root, relPath, extension, allowLongHashes=False,  silent=False, useRawHashes=False):
+    def SharesHashes(self, other, capabilities):
+        """Whether this table and other agree on the capabilities given, so their hashes can be compared"""
+        return set(self.capabilities) & set(capabilities) == set(other.capabilities) & set(capabilities)
+
+    def IsSizeKnown(self, fileSize):
+        """A file can only hard collide with an entry of the same size"""
+        return fileSize in self.ginSize
+
+    def _HashDeferredEntries(self, root, fileSize, allowLongHashes, useRawHashes):
+        """Hash the entries a size-first scan stored without hashes, now that their size has come up again"""
+        if not fileSize in self.ginSize:
+            return
+
+        for idx in self.ginSize.Find(fileSize):
+            if not self.hashList.IsDeferred(idx):
+                continue
+
+            # Whatever happens, this is the only attempt
+            self.hashList.ClearDeferred(idx)
+
+            if idx in self.removedIndices or not self._IsEntryLive(idx):
+                continue
+
+            sz, shs, lhs, nm, ph = self.hashList[idx]
+            segments = None
+            tiers = None
+
+            try:
+                with self.HashElement(root, nm[0], nm[1], useRawHashes) as element:
+                    if element.fileSize != sz:
+                        print("[WARN] File {} has changed size since it was added, leaving it unhashed".format(nm[0]))
+                        continue
+
+                    shs = element.ShortHash()
+                    if allowLongHashes:
+                        lhs = element.LongHash()
+                        segments = element.Segments()
+                        tiers = element.Tiers()
+            except KeyboardInterrupt as kbi:
+                raise kbi
+            except Exception as e:
+                print("[WARN] Failed to hash deferred entry {} ({})".format(nm[0], e))
+                continue
+
+            self.hashList.SetHashes(idx, shs, lhs)
+            self.hashList.SetSegments(idx, segments)
+            self.hashList.SetTiers(idx, tiers)
+            self.journalHashed.add(idx)
+            self._AddToGin("Short", HashStore.KeyOf(shs), idx)
+
+            if lhs is not None:
+                self._AddToGin("Long", HashStore.KeyOf(lhs), idx)
+
+    def HashElement(self, root, relPath, extension, useRawHashes=False, stat=None):
+        """Create the hash set for a file. Nothing is hashed until it is asked for or primed"""
+        return CElementHashes(self, root, relPath, extension, useRawHashes, stat=stat)
+
+    def EntryElement(self, entry):
+        """Wrap an entry, usually from another table, so it can be checked without touching the disk"""
+        sz, shs, lhs, nm, ph = entry
+        return CElementHashes(self, None, nm[0], nm[1], fileSize=sz, hashes={"Short": shs, "Long": lhs, "Perceptual": ph})
+
+    def _ShortCandidates(self, element, shortHash):
+        """Live entries with the element's size and short hash"""
+        return [idx for idx in self.ginShortHash.Find(HashStore.KeyOf(shortHash)) if not idx in self.removedIndices and self._IsEntryLive(idx) and self.hashList.Size(idx) == element.fileSize and self.hashList.ShortHash(idx) == shortHash]
+
+    def _BackfillLongHashes(self, root, element, shortHash, useRawHashes, silent):
         """
-        Check Element against internal file list
+        Give entries added without a long hash (--short-hash) one, when they short collide with element
 
-        Raises:
-            IOError
+        Entries that differ from element in a prefix tier are left as they are, so only likely
+        duplicates are read in full
         """
-        
-        # Get file size
-        fullPath = os.path.join(root, relPath)
-        l_FileSize = os.path.getsize(fullPath)
+        for idx in self._ShortCandidates(element, shortHash):
+            sz, shs, lhs, nm, ph = self.hashList[idx]
 
-        # Is the file empty? It'll collide with every other empty file
-        if l_FileSize == 0:
-            print("[EMPTY] File {} is empty".format(self._SanitisePath(relPath)))
-            return True
+            if lhs is not None:
+                continue
+
+            try:
+                with self.HashElement(root, nm[0], nm[1], useRawHashes) as existing:
+                    if existing.fileSize != sz or existing.ShortHash() != shs:
+                        print("[WARN] File {} has changed since it was added, leaving it without a long hash".format(nm[0]))
+                        continue
+
+                    if any(existing.TierHash(tier) != element.TierHash(tier) for tier in range(existing._TierCount())):
+                        continue
+
+                    lhs = existing.LongHash()
+                    segments = existing.Segments()
+                    tiers = existing.Tiers()
+            except KeyboardInterrupt as kbi:
+                raise kbi
+            except Exception as e:
+                print("[WARN] Failed to backfill the long hash of {} ({})".format(nm[0], e))
+                continue
+
+            self.hashList.SetHashes(idx, shs, lhs)
+            self.hashList.SetSegments(idx, segments)
+            self.hashList.SetTiers(idx, tiers)
+            self.journalHashed.add(idx)
+            self._AddToGin("Long", HashStore.KeyOf(lhs), idx)
+
+            if not silent:
+                print("[INFO] Backfilled Long Hash: {}".format(nm[0]))
+
+    def _TiersRuleOut(self, element, shortHash):
+        """True when every entry sharing the element's size and short hash differs from it in some prefix tier"""
+        size = HashStore.DIGEST_SIZE
+
+        # Entries without a long hash can't be confirmed against anyway
+        candidates = [idx for idx in self._ShortCandidates(element, shortHash) if self.hashList.LongHash(idx) is not None]
+
+        for tier in range(len(TIER_SIZES)):
+            if not candidates:
+                break
+
+            # Entries without this tier can't be told apart by it
+            tiers = [self.hashList.Tiers(idx) or b"" for idx in candidates]
+            if any(len(x) < (tier + 1) * size for x in tiers):
+                return False
+
+            hTier = element.TierHash(tier)
+            if hTier is None:
+                return False
+
+            candidates = [idx for idx, x in zip(candidates, tiers) if x[tier * size:(tier + 1) * size] == hTier]
+
+        return not candidates
 
-        with open(fullPath, "rb") as ele:
+    def _FindElement(self, root, element, allowLongHashes, silent, useRawHashes, deferHashes):
+        """Look an element up, hashing only as far as needed. Returns the (index, mode) of the entry it collided with, or (None, None)"""
+        relPath = element.relPath
+        extension = element.extension
+        l_FileSize = element.fileSize
 
+        # Entries left unhashed by a size-first scan need hashes before we can compare against them
+        # There is nothing on disk to hash when checking elements taken from another table
+        if root is not None:
+            self._HashDeferredEntries(root, l_FileSize, allowLongHashes, useRawHashes)
+
+        # Nothing has our size, so nothing can hard collide. Only the perceptual check is left
+        if not (deferHashes and not self.IsSizeKnown(l_FileSize)):
             # Get 'Short' Hash
-            l_shortHash = self._ShortHashSelector(ele, l_FileSize, relPath, extension, useRawHashes)
+            l_shortHash = element.ShortHash()
 
             # Also silence this call when long hashes are allowed. We don't care if miss the call in that case
             # If they are really different, the deep check will pick it up
-            if self._DoesShortHashCollide(l_FileSize, (relPath, extension), l_shortHash, silent or allowLongHashes):
+            idx = self._FindCollision(l_FileSize, (relPath, extension), l_shortHash, None, silent or allowLongHashes)
+            if idx is not None:
                 # Short collided, we want to do a full check if enabled
                 if allowLongHashes:
-                    l_longHash = self._LongHashSelector(ele, l_FileSize, relPath, extension, useRawHashes)
-
-                    if self._DoesLongHashCollide(l_FileSize, (relPath, extension), l_longHash, silent):
-                        # We definitely know this one, so let's return that
-                        return True
+                    # Tables built with short hashes only get long hashes as they turn out to be needed
+                    if root is not None:
+                        self._BackfillLongHashes(root, element, l_shortHash, useRawHashes, silent)
+
+                    # Prefixes first, so a file that differs early is turned away before reading the rest
+                    # That only saves reading where the file's long hash isn't wanted anyway: checks that don't
+                    # add (IsElementKnown) and short hash only scans (-sh). A file that gets added is read in
+                    # full by AddElement, or already was if a worker primed it
+                    if not self._TiersRuleOut(element, l_shortHash):
+                        l_longHash = element.LongHash()
+
+                        idx = self._FindCollision(l_FileSize, (relPath, extension), None, l_longHash, silent)
+                        if idx is not None:
+                            # We definitely know this one, so let's return that
+                            return idx, "Long"
                 else:
                     # Since we can't long hash check, get ready to return that we know the element
-                    return True
+                    return idx, "Short"
 
-            # If we are here, then we did not match short or long hashes
-            if EXT_PerceptualHash in self.capabilities and allowLongHashes:
-                # Do the perceptual hash
-                l_phash = self._PerceptualHash(ele, l_FileSize, relPath, extension, useRawHashes, fullPath)
+        # If we are here, then we did not match short or long hashes
+        if EXT_PerceptualHash in self.capabilities and allowLongHashes:
+            # Do the perceptual hash
+            l_phash = element.PerceptualHash()
 
-                if l_phash is not None:
-                    if self._DoesPerceptualHashCollide(l_FileSize, (relPath, extension), l_phash, silent):
-                        return True              
+            if l_phash is not None:
+                idx = self._FindCollision(l_FileSize, (relPath, extension), None, None, silent, l_phash)
+                if idx is not None:
+                    return idx, "Perc"
 
-        return False
+        return None, None
+
+    def IsElementKnown(self, root, relPath, extension, allowLongHashes=False,  silent=False, useRawHashes=False, element=None, deferHashes=False):
+        """
+        Check Element against internal file list
+
+        Element may come from HashElement, in which case hashes it already holds are reused
+        DeferHashes skips reading the file when no entry shares its size
+
+        Raises:
+            IOError
+        """
+        
+        result = self.CheckAndAddElement(root, relPath, extension, allowLongHashes, silent, useRawHashes, element=element, deferHashes=deferHashes, addUnknown=False)
+        return result.IsKnown()
+
+    def CheckAndAddElement(self, root, relPath, extension, allowLongHashes=False, silent=False, useRawHashes=False, useLongHash=True, disableCheckpoint=False, element=None, deferHashes=False, addUnknown=True):
+        """
+        IsElementKnown followed by AddElement when the element is new, reading and hashing the file once
+
+        Root may be None when element holds hashes taken from another table (see EntryElement)
+        AddUnknown = Add the element when it's new. Otherwise only check it
 
-    def AddElement(self, root, relPath, extension, silent=True, useLongHash=True, useRawHashes=False, disableCheckpoint=False):
+        Returns a CElementResult
+
+        Raises:
+            IOError
+        """
+        if element is None:
+            with self.HashElement(root, relPath, extension, useRawHashes) as ownElement:
+                return self.CheckAndAddElement(root, relPath, extension, allowLongHashes, silent, useRawHashes, useLongHash, disableCheckpoint, ownElement, deferHashes, addUnknown)
+
+        # Is the file empty? It'll collide with every other empty file
+        if element.fileSize == 0:
+            print("[EMPTY] File {} is empty".format(self._SanitisePath(relPath)))
+
+            if addUnknown and root is not None and element.stat is not None:
+                self.RecordResolved(relPath, element.stat, None)
+            return CElementResult(RESULT_EMPTY)
+
+        idx, mode = self._FindElement(root, element, allowLongHashes, silent, useRawHashes, deferHashes)
+
+        if idx is not None:
+            # Scanning, so an incremental scan can pass over this duplicate next time
+            if addUnknown and root is not None and element.stat is not None:
+                self.RecordResolved(relPath, element.stat, idx)
+            return CElementResult(RESULT_KNOWN, mode, idx, self.hashList[idx])
+
+        if not addUnknown:
+            return CElementResult(RESULT_UNKNOWN)
+
+        self.AddElement(root, relPath, extension, silent, useLongHash, useRawHashes, disableCheckpoint, element, deferHashes)
+
+        idx = len(self.hashList) - 1
+        return CElementResult(RESULT_ADDED, None, idx, self.hashList[idx])
+
+    def AddElement(self, root, relPath, extension, silent=True, useLongHash=True, useRawHashes=False, disableCheckpoint=False, element=None, deferHashes=False):
         """
             Root = Base Directory
             RelPath = Relative offset from Base
@@ -631,35 +1662,185 @@ class CHashList():
 
             Silent = Mutes output
             useLongHash = Should the longer hash be generated
+            Element = Hashes from HashElement to reuse, if any
+            DeferHashes = Store files of a size not yet in the table without hashing them
         """
+        if element is None:
+            with self.HashElement(root, relPath, extension, useRawHashes) as ownElement:
+                return self.AddElement(root, relPath, extension, silent, useLongHash, useRawHashes, disableCheckpoint, ownElement, deferHashes)
+
         saneRelPath = self._SanitisePath(relPath)
 
-        fullPath = os.path.join(root, relPath)
-        l_FileSize = os.path.getsize(fullPath)
+        l_FileSize = element.fileSize
+        l_shortHash = None
+        l_longHash = None
 
-        with open(fullPath, "rb") as ele:
-            l_shortHash = self._ShortHashSelector(ele, l_FileSize, relPath, extension, useRawHashes)
-            l_longHash = None
+        # Unique sizes can't collide, so their hashes wait until a second file of that size is seen
+        bDeferred = deferHashes and not self.IsSizeKnown(l_FileSize)
+
+        if not bDeferred:
+            l_shortHash = element.ShortHash()
 
             if useLongHash:
-                l_longHash = self._LongHashSelector(ele, l_FileSize, relPath, extension, useRawHashes)
-                
-            l_PercHash = None
-            if EXT_PerceptualHash in self.capabilities:
-                l_PercHash = self._PerceptualHash(ele, l_FileSize, relPath, extension, useRawHashes, fullPath)
+                l_longHash = element.LongHash()
+            
+        l_PercHash = None
+        if EXT_PerceptualHash in self.capabilities:
+            l_PercHash = element.PerceptualHash()
+
+        # FORMAT: Size, SH, LH, (Rel+Type), PH
+        row = self.hashList.Append((l_FileSize, l_shortHash, l_longHash, (saneRelPath, extension), l_PercHash))
+        self._AddToGINs(row)
+
+        if l_longHash is not None:
+            self.hashList.SetSegments(row, element.Segments())
+            self.hashList.SetTiers(row, element.Tiers())
 
-            # FORMAT: Size, SH, LH, (Rel+Type), PH
-            self.hashList.append((l_FileSize, l_shortHash, l_longHash, (saneRelPath, extension), l_PercHash))
-            self._AddToGINs(len(self.hashList) - 1)
+        if element.stat is not None:
+            self.hashList.SetStat(row, self._StatKey(element.stat))
 
         self.unserialisedBytes += l_FileSize
 
         if self.unserialisedBytes > 256 * 1024 * 1024 and not disableCheckpoint:
             print("[CHECKPOINT] Saving Checkpoint")
-            self.Write(self.storeName + b".tmp", True)
+            self.Checkpoint()
             self.unserialisedBytes = 0
 
+    def _SnapshotId(self, data):
+        return hashlib.sha3_256(data).digest()
+
+    def _JournalPath(self):
+        return os.fsencode(self.storeName) + b".journal"
+
+    def _ReplayJournal(self):
+        """Apply the journal's records on top of the table that was just loaded"""
+        journalPath = self._JournalPath()
+
+        if not os.path.exists(journalPath):
+            return
+
+        with open(journalPath, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        records = 0
+        while offset + 8 <= len(data):
+            length = int.from_bytes(data[offset:offset + 8], "little")
+            blob = data[offset + 8:offset + 8 + length]
+
+            if len(blob) < length:
+                break
+
+            try:
+                pickled = EncryptionHelpers.Decrypt(blob, self.machineKey, self.snapshotId)
+            except cryptography.exceptions.InvalidTag:
+                break
+
+            vn, changes = pickle.loads(pickled)
+            if vn > JOURNAL_VERSION_NUMBER:
+                raise RuntimeError("Journal version {} is newer than this version supports".format(vn))
+
+            self._ApplyJournalRecord(changes)
+
+            offset += 8 + length
+            records += 1
+
+        if offset < len(data):
+            if records == 0:
+                print("[WARN] Journal {} does not belong to this table. Ignoring it".format(journalPath))
+            else:
+                print("[WARN] Journal {} ends in a partial checkpoint. Ignoring the tail".format(journalPath))
+
+        # The next checkpoint overwrites anything we couldn't read
+        self.journalLength = offset
+
+        # Callers that go through hashList directly would still see what the journal removed.
+        # The next checkpoint becomes a full write, as after any compaction
+        self._CompactEntries()
+
+        if records > 0:
+            print("[INFO] Replayed {} Checkpoints, now {} References".format(records, len(self.hashList)))
+
+    def _ApplyJournalRecord(self, changes):
+        first = self.hashList.Extend(HashStore.CHashStore.FromPacked(changes["Rows"]))
+
+        for idx in range(first, len(self.hashList)):
+            self._AddToGINs(idx)
+
+        for idx, (shs, lhs) in changes["Hashes"].items():
+            self.hashList.SetHashes(idx, shs, lhs)
+
+            if shs is not None:
+                self._AddToGin("Short", HashStore.KeyOf(shs), idx)
+            if lhs is not None:
+                self._AddToGin("Long", HashStore.KeyOf(lhs), idx)
+
+        for idx, segments in changes.get("Segments", {}).items():
+            self.hashList.SetSegments(idx, segments)
+
+        for idx, tiers in changes.get("Tiers", {}).items():
+            self.hashList.SetTiers(idx, tiers)
+
+        self.removedIndices.update(changes["Removed"])
+
+        # Journals from before this have none
+        self.resolvedPaths.update(changes.get("Resolved", {}))
+
+        self.journalRows = len(self.hashList)
+        self.journalRemoved = set(self.removedIndices)
+
+    def Checkpoint(self):
+        """
+        Save progress cheaply. Only what changed since the last checkpoint is appended to the journal
+
+        Write folds the journal back into the table. Once rows have been compacted away, the
+        journal can't describe the table any more, so this falls back to a full write
+        """
+        if self.storeName is None:
+            return
+
+        if self.journalStale:
+            self.Write()
+            return
+
+        changes = {
+            "Rows": self.hashList.CopyRows(self.journalRows).Pack(),
+            "Hashes": {idx: (self.hashList.ShortHash(idx), self.hashList.LongHash(idx)) for idx in self.journalHashed if idx < self.journalRows},
+            "Segments": {idx: self.hashList.Segments(idx) for idx in self.journalHashed if idx < self.journalRows},
+            "Tiers": {idx: self.hashList.Tiers(idx) for idx in self.journalHashed if idx < self.journalRows},
+            "Resolved": self.journalResolved,
+            "Removed": self.removedIndices - self.journalRemoved
+        }
+
+        pickled = pickle.dumps((JOURNAL_VERSION_NUMBER, changes))
+        blob = EncryptionHelpers.Encrypt(pickled, self.machineKey, self.snapshotId)
+
+        journalPath = self._JournalPath()
+        with open(journalPath, "rb+" if os.path.exists(journalPath) else "wb+") as f:
+            # Drop any partial record a crash left behind
+            f.seek(self.journalLength)
+            f.write(len(blob).to_bytes(8, "little"))
+            f.write(blob)
+            f.truncate()
+
+        self.journalLength += 8 + len(blob)
+        self.journalRows = len(self.hashList)
+        self.journalRemoved = set(self.removedIndices)
+        self.journalHashed = set()
+        self.journalResolved = {}
+
+    def _Serialise(self):
+        sections = {
+            "Index": self._PackGINs(),
+            "Resolved": self.resolvedPaths
+        }
+
+        pickled = pickle.dumps((HASHLIST_VERSION_NUMBER, self.capabilities, self.hashList.Pack(), sections))
+        return EncryptionHelpers.Encrypt(pickled, self.machineKey)
+
     def Write(self, path=None, overwrite=False):
+        self._CompactEntries()
+
         if path:
             # if not os.path.exists(path):
             #     os.makedirs(path)
@@ -669,18 +1850,34 @@ class CHashList():
 
             if os.path.exists(path) and not overwrite: # Again after the first because we may have made a new file
                 with open(path, "rb+") as f:
-                    pickled = pickle.dumps((HASHLIST_VERSION_NUMBER, self.capabilities, self.hashList))
-                    f.write(EncryptionHelpers.Encrypt(pickled, self.machineKey))
+                    f.write(self._Serialise())
+                    f.truncate()
             else:
                 with open(path, "wb+") as f:
-                    pickled = pickle.dumps((HASHLIST_VERSION_NUMBER, self.capabilities, self.hashList))
-                    f.write(EncryptionHelpers.Encrypt(pickled, self.machineKey))
+                    f.write(self._Serialise())
         else:
+            if self.storeName is None:
+                raise ValueError("In memory table has nowhere to be written")
+
+            data = self._Serialise()
+
             if os.path.exists(self.storeName):
                 with open(self.storeName, "rb+") as f:
-                    pickled = pickle.dumps((HASHLIST_VERSION_NUMBER, self.capabilities, self.hashList))
-                    f.write(EncryptionHelpers.Encrypt(pickled, self.machineKey))
+                    # The table may have shrunk, don't leave the old tail behind
+                    f.write(data)
+                    f.truncate()
             else:
                 with open(self.storeName, "wb+") as f:
-                    pickled = pickle.dumps((HASHLIST_VERSION_NUMBER, self.capabilities, self.hashList))
-                    f.write(EncryptionHelpers.Encrypt(pickled, self.machineKey))
\ No newline at end of file
+                    f.write(data)
+
+            # Everything in the journal is in the table now
+            self.snapshotId = self._SnapshotId(data)
+            self.journalRows = len(self.hashList)
+            self.journalRemoved = set()
+            self.journalHashed = set()
+            self.journalResolved = {}
+            self.journalLength = 0
+            self.journalStale = False
+
+            if os.path.exists(self._JournalPath()):
+                os.remove(self._JournalPath())
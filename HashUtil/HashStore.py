@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+
+import hashlib
+
+# Better Arrays
+import numpy
+
+# SHA3_256 and SHA512_256 both give 32 bytes
+DIGEST_SIZE = 32
+
+# Per-row flags
+FLAG_SHORT = 1
+FLAG_LONG = 2
+FLAG_DEFERRED = 4
+FLAG_STAT = 8
+
+# Bump when the packed layout changes
+STORE_LAYOUT_VERSION = 1
+
+# Bump when KeyOf changes, so saved indices get rebuilt
+INDEX_LAYOUT_VERSION = 1
+
+
+def KeyOf(value):
+    """64 bit index key for a hash, path or anything else we look up
+
+    Digests are already uniform, so the first 8 bytes are used as is. Everything else is hashed down"""
+    if isinstance(value, bytes) and len(value) == DIGEST_SIZE:
+        return int.from_bytes(value[:8], "little")
+
+    if isinstance(value, str):
+        value = value.encode()
+    elif not isinstance(value, (bytes, bytearray)):
+        value = numpy.asarray(value).tobytes()
+
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "little")
+
+
+class CKeyIndex():
+    """
+    Inverted index from 64 bit keys to rows, kept as a pair of sorted arrays
+
+    Recent additions wait in a small dict and are merged in once there are enough of them.
+    Keys are hashes of the real values, so callers still have to compare the rows they get back
+    """
+
+    MERGE_MINIMUM = 4096
+
+    def __init__(self):
+        self.keys = numpy.empty(0, dtype=numpy.uint64)
+        self.rows = numpy.empty(0, dtype=numpy.int64)
+        self.recent = {}
+        self.recentCount = 0
+
+    def Build(self, keys, rows):
+        """Replace the index. Rows sharing a key are kept in row order"""
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+
+        order = numpy.lexsort((rows, keys))
+        self.keys = keys[order]
+        self.rows = rows[order]
+        self.recent = {}
+        self.recentCount = 0
+
+    def Add(self, key, row):
+        if key in self.recent:
+            self.recent[key].append(row)
+        else:
+            self.recent[key] = [row]
+
+        self.recentCount += 1
+
+        if self.recentCount > max(self.MERGE_MINIMUM, len(self.keys) // 4):
+            self._Merge()
+
+    def _Merge(self):
+        recentKeys = []
+        recentRows = []
+        for key, rows in self.recent.items():
+            recentKeys.extend([key] * len(rows))
+            recentRows.extend(rows)
+
+        self.Build(
+            numpy.concatenate((self.keys, numpy.array(recentKeys, dtype=numpy.uint64))),
+            numpy.concatenate((self.rows, numpy.array(recentRows, dtype=numpy.int64)))
+        )
+
+    def _Range(self, key):
+        npKey = numpy.uint64(key)
+        return numpy.searchsorted(self.keys, npKey, "left"), numpy.searchsorted(self.keys, npKey, "right")
+
+    def Find(self, key):
+        """Rows stored under key, oldest first"""
+        lo, hi = self._Range(key)
+        return self.rows[lo:hi].tolist() + self.recent.get(key, [])
+
+    def Remap(self, newRows):
+        """Follow rows to where a compaction moved them. Rows mapped to -1 are dropped"""
+        if self.recent:
+            self._Merge()
+
+        mapped = newRows[self.rows]
+        keep = mapped >= 0
+
+        # Compaction keeps rows in order, so nothing needs sorting again
+        self.keys = self.keys[keep]
+        self.rows = mapped[keep]
+
+    def Pack(self):
+        if self.recent:
+            self._Merge()
+
+        return {"Keys": self.keys, "Rows": self.rows}
+
+    def Unpack(self, packed):
+        """Take over a packed index. Returns False if it can't be used"""
+        self.keys = numpy.asarray(packed["Keys"], dtype=numpy.uint64)
+        self.rows = numpy.asarray(packed["Rows"], dtype=numpy.int64)
+        self.recent = {}
+        self.recentCount = 0
+        return True
+
+    def __contains__(self, key):
+        if key in self.recent:
+            return True
+
+        lo, hi = self._Range(key)
+        return hi > lo
+
+    def __len__(self):
+        return len(self.keys) + self.recentCount
+
+
+# Set bits in each byte value, for when numpy.bitwise_count isn't there (NumPy < 2)
+_POPCOUNT = numpy.array([bin(x).count("1") for x in range(256)], dtype=numpy.uint8)
+
+
+def HammingDistances(a, b):
+    """Bits that differ between each row of a and each row of b, as a len(a) x len(b) matrix
+
+    Rows are packed bits (uint8). Memory use is around 40 bytes per pair, so tile large inputs"""
+    a = numpy.ascontiguousarray(a, dtype=numpy.uint8)
+    b = numpy.ascontiguousarray(b, dtype=numpy.uint8)
+
+    if hasattr(numpy, "bitwise_count") and a.shape[1] % 8 == 0:
+        words = a.view("<u8")[:, None, :] ^ b.view("<u8")[None, :, :]
+        return numpy.bitwise_count(words).sum(axis=2, dtype=numpy.uint16)
+
+    return _POPCOUNT[a[:, None, :] ^ b[None, :, :]].sum(axis=2, dtype=numpy.uint16)
+
+
+class CHammingIndex():
+    """
+    Finds every hash within radius bits of a query without comparing against all of them
+
+    Multi-index hashing: hashes are cut into 16 bit chunks. Two hashes within radius bits
+    of each other have at least one chunk within radius // chunks bits (pigeonhole), so only
+    buckets near the query's own chunks are looked in. Buckets are sorted position arrays,
+    one set per chunk. Recent additions are scanned directly until there are enough to sort in.
+    Hashes that aren't hashBytes long can't be chunked and are always returned
+    """
+
+    CHUNK_BITS = 16
+    MERGE_MINIMUM = 4096
+
+    def __init__(self, hashBytes, radius):
+        self.hashBytes = hashBytes
+        self.radius = radius
+        self.chunks = hashBytes * 8 // self.CHUNK_BITS
+
+        # Every bucket within chunkRadius bits of a chunk is XOR with one of these
+        chunkRadius = radius // self.chunks
+        self.probes = numpy.array([x for x in range(1 << self.CHUNK_BITS) if bin(x).count("1") <= chunkRadius], dtype=numpy.int64)
+
+        self._Clear()
+
+    def _Clear(self):
+        self.count = 0
+        self.hashes = numpy.zeros((0, self.hashBytes), dtype=numpy.uint8)
+        self.rows = numpy.zeros(0, dtype=numpy.int64)
+        self.others = []
+
+        self.sortedCount = 0
+        self.order = numpy.zeros((self.chunks, 0), dtype=numpy.int32)
+        self.starts = numpy.zeros((self.chunks, (1 << self.CHUNK_BITS) + 1), dtype=numpy.int64)
+
+    def _Bits(self, value):
+        if isinstance(value, bytes) and len(value) == self.hashBytes:
+            return numpy.frombuffer(value, dtype=numpy.uint8)
+        return None
+
+    def Build(self, keys, rows):
+        """Replace the index. Keys are raw hashes"""
+        self._Clear()
+
+        for key, row in zip(keys, rows):
+            self.Add(key, row)
+
+        self._Sort()
+
+    def Add(self, key, row):
+        bits = self._Bits(key)
+
+        if bits is None:
+            self.others.append(row)
+            return
+
+        if self.count == len(self.hashes):
+            capacity = max(1024, self.count * 2)
+            self.hashes = numpy.resize(self.hashes, (capacity, self.hashBytes))
+            self.rows = numpy.resize(self.rows, capacity)
+
+        self.hashes[self.count] = bits
+        self.rows[self.count] = row
+        self.count += 1
+
+    def _Sort(self):
+        """Rebuild the buckets over every position"""
+        chunkValues = self.hashes[:self.count].view(">u2")
+        self.order = numpy.zeros((self.chunks, self.count), dtype=numpy.int32)
+
+        for chunk in range(self.chunks):
+            values = chunkValues[:, chunk]
+
+            # 16 bit keys, so this is a radix sort
+            self.order[chunk] = numpy.argsort(values, kind="stable")
+            self.starts[chunk, 1:] = numpy.cumsum(numpy.bincount(values, minlength=1 << self.CHUNK_BITS))
+
+        self.sortedCount = self.count
+
+    def Find(self, key):
+        """Rows within radius bits of key, oldest first. Every row if key can't be chunked"""
+        bits = self._Bits(key)
+
+        if bits is None:
+            return sorted(self.rows[:self.count].tolist() + self.others)
+
+        if self.count - self.sortedCount > max(self.MERGE_MINIMUM, self.sortedCount // 8):
+            self._Sort()
+
+        candidates = [numpy.arange(self.sortedCount, self.count, dtype=numpy.int32)]
+
+        for chunk, value in enumerate(bits.view(">u2")):
+            buckets = self.probes ^ int(value)
+            for lo, hi in zip(self.starts[chunk, buckets], self.starts[chunk, buckets + 1]):
+                if hi > lo:
+                    candidates.append(self.order[chunk, lo:hi])
+
+        positions = numpy.unique(numpy.concatenate(candidates))
+        distances = HammingDistances(self.hashes[positions], bits[None, :])[:, 0]
+        positions = positions[distances <= self.radius]
+
+        return sorted(self.rows[positions].tolist() + self.others)
+
+    def Remap(self, newRows):
+        """Follow rows to where a compaction moved them. Rows mapped to -1 are dropped"""
+        rows = newRows[self.rows[:self.count]]
+        keep = rows >= 0
+
+        self.hashes = self.hashes[:self.count][keep]
+        self.rows = rows[keep]
+        self.count = len(self.rows)
+        self.others = [int(newRows[row]) for row in self.others if newRows[row] >= 0]
+
+        self._Sort()
+
+    def Pack(self):
+        return {"HashBytes": self.hashBytes, "Radius": self.radius, "Hashes": self.hashes[:self.count], "Rows": self.rows[:self.count], "Others": self.others}
+
+    def Unpack(self, packed):
+        """Take over a packed index. Returns False if it was made for other hashes or another radius"""
+        if packed.get("HashBytes") != self.hashBytes or packed.get("Radius") != self.radius:
+            return False
+
+        self._Clear()
+        self.hashes = numpy.array(packed["Hashes"], dtype=numpy.uint8).reshape(-1, self.hashBytes)
+        self.rows = numpy.array(packed["Rows"], dtype=numpy.int64)
+        self.count = len(self.rows)
+        self.others = list(packed["Others"])
+
+        # Buckets are sorted on first use
+        return True
+
+    def __len__(self):
+        return self.count + len(self.others)
+
+
+class CHashStore():
+    """
+    Entries kept column by column instead of as a list of tuples
+
+    Sizes, digests and stat data sit in NumPy arrays and paths in one blob, so a large
+    table costs a few dozen bytes per entry. Indexing or iterating still gives the usual
+    (size, shortHash, longHash, (relPath, ext), perceptual) tuples
+    """
+
+    def __init__(self, capacity=1024):
+        self.count = 0
+        self.capacity = 0
+
+        self.sizes = numpy.zeros(0, dtype=numpy.int64)
+        self.flags = numpy.zeros(0, dtype=numpy.uint8)
+        self.shortHashes = numpy.zeros((0, DIGEST_SIZE), dtype=numpy.uint8)
+        self.longHashes = numpy.zeros((0, DIGEST_SIZE), dtype=numpy.uint8)
+        self.extensionIds = numpy.zeros(0, dtype=numpy.int32)
+        self.pathEnds = numpy.zeros(0, dtype=numpy.int64)
+        self.statDevices = numpy.zeros(0, dtype=numpy.uint64)
+        self.statInodes = numpy.zeros(0, dtype=numpy.uint64)
+        self.statTimes = numpy.zeros(0, dtype=numpy.int64)
+
+        self.pathBlob = bytearray()
+
+        # Few distinct extensions, so rows only hold an id
+        self.extensions = []
+        self.extensionLookup = {}
+
+        # Sparse. Most files aren't images
+        self.perceptual = {}
+
+        # Leaf digests of tree hashed files, joined, by row. Only files of more than one segment
+        self.segments = {}
+
+        # Prefix digests (see HashList.TIER_SIZES), joined, by row. Only tiers shorter than the file
+        self.tiers = {}
+
+        # Hashes that don't fit a DIGEST_SIZE column, by (flag, row)
+        self.oddHashes = {}
+
+        self._Reserve(capacity)
+
+    def _Reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+
+        capacity = max(capacity, self.capacity * 2)
+
+        for name in ("sizes", "flags", "shortHashes", "longHashes", "extensionIds", "pathEnds", "statDevices", "statInodes", "statTimes"):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+        self.capacity = capacity
+
+    def _ExtensionId(self, extension):
+        if not extension in self.extensionLookup:
+            self.extensionLookup[extension] = len(self.extensions)
+            self.extensions.append(extension)
+
+        return self.extensionLookup[extension]
+
+    def _SetHash(self, flag, column, row, value):
+        self.flags[row] &= ~numpy.uint8(flag)
+        self.oddHashes.pop((flag, row), None)
+
+        if value is None:
+            return
+
+        if isinstance(value, bytes) and len(value) == DIGEST_SIZE:
+            column[row] = numpy.frombuffer(value, dtype=numpy.uint8)
+            self.flags[row] |= flag
+        else:
+            self.oddHashes[(flag, row)] = value
+
+    def _GetHash(self, flag, column, row):
+        if self.flags[row] & flag:
+            return column[row].tobytes()
+
+        return self.oddHashes.get((flag, row))
+
+    def _Row(self, row):
+        if row < 0:
+            row += self.count
+
+        if row < 0 or row >= self.count:
+            raise IndexError("Row {} is out of range".format(row))
+
+        return row
+
+    def Append(self, entry):
+        """Add an entry tuple. Returns its row"""
+        sz, shs, lhs, nm, ph = entry
+
+        self._Reserve(self.count + 1)
+        row = self.count
+        self.count += 1
+
+        self.sizes[row] = sz
+        self.flags[row] = 0
+        self.SetHashes(row, shs, lhs)
+
+        self.extensionIds[row] = self._ExtensionId(nm[1])
+        self.pathBlob += nm[0]
+        self.pathEnds[row] = len(self.pathBlob)
+
+        if ph is not None:
+            self.perceptual[row] = ph
+
+        return row
+
+    def SetHashes(self, row, shortHash, longHash):
+        """Fill in the hashes of an existing row. Rows with a size but no short hash are deferred"""
+        self._SetHash(FLAG_SHORT, self.shortHashes, row, shortHash)
+        self._SetHash(FLAG_LONG, self.longHashes, row, longHash)
+
+        if shortHash is None and self.sizes[row] > 0:
+            self.flags[row] |= FLAG_DEFERRED
+        else:
+            self.flags[row] &= ~numpy.uint8(FLAG_DEFERRED)
+
+    def IsDeferred(self, row):
+        return bool(self.flags[row] & FLAG_DEFERRED)
+
+    def ClearDeferred(self, row):
+        """Stop treating a row as waiting for hashes, even though it has none"""
+        self.flags[row] &= ~numpy.uint8(FLAG_DEFERRED)
+
+    def SetStat(self, row, statKey):
+        """Store (Device, Inode, Size, MTime). Size is the row's own"""
+        dev, ino, _, mtime = statKey
+
+        self.statDevices[row] = dev
+        self.statInodes[row] = ino
+        self.statTimes[row] = mtime
+        self.flags[row] |= FLAG_STAT
+
+    def Stat(self, row):
+        """(Device, Inode, Size, MTime) of the row's file when it was hashed, or None"""
+        if not self.flags[row] & FLAG_STAT:
+            return None
+
+        return (int(self.statDevices[row]), int(self.statInodes[row]), int(self.sizes[row]), int(self.statTimes[row]))
+
+    def Size(self, row):
+        return int(self.sizes[row])
+
+    def Path(self, row):
+        start = self.pathEnds[row - 1] if row > 0 else 0
+        return bytes(self.pathBlob[start:self.pathEnds[row]])
+
+    def Extension(self, row):
+        return self.extensions[self.extensionIds[row]]
+
+    def ShortHash(self, row):
+        return self._GetHash(FLAG_SHORT, self.shortHashes, row)
+
+    def LongHash(self, row):
+        return self._GetHash(FLAG_LONG, self.longHashes, row)
+
+    def Perceptual(self, row):
+        return self.perceptual.get(row)
+
+    def SetSegments(self, row, segments):
+        """Store the leaf digests of a tree hash, joined. None clears them"""
+        if segments is None:
+            self.segments.pop(row, None)
+        else:
+            self.segments[row] = segments
+
+    def Segments(self, row):
+        return self.segments.get(row)
+
+    def SetTiers(self, row, tiers):
+        """Store a row's prefix digests, joined. None clears them"""
+        if tiers is None:
+            self.tiers.pop(row, None)
+        else:
+            self.tiers[row] = tiers
+
+    def Tiers(self, row):
+        return self.tiers.get(row)
+
+    def Sizes(self):
+        """Every row's size, as a view"""
+        return self.sizes[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        row = self._Row(row)
+        return (self.Size(row), self.ShortHash(row), self.LongHash(row), (self.Path(row), self.Extension(row)), self.Perceptual(row))
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self[row]
+
+    def RowsWithExtensions(self, extensions):
+        """Rows whose extension, lowercased, is one of extensions"""
+        ids = [idx for idx, ext in enumerate(self.extensions) if ext.lower() in extensions]
+        return numpy.flatnonzero(numpy.isin(self.extensionIds[:self.count], ids)).tolist()
+
+    def HashKeys(self, flag):
+        """(keys, rows) of every row holding the short or long hash, for building a CKeyIndex"""
+        column = self.shortHashes if flag == FLAG_SHORT else self.longHashes
+
+        rows = numpy.flatnonzero(self.flags[:self.count] & flag)
+        keys = numpy.ascontiguousarray(column[rows, :8]).view("<u8").ravel().astype(numpy.uint64)
+
+        oddRows = sorted(row for oddFlag, row in self.oddHashes if oddFlag == flag)
+        if oddRows:
+            oddKeys = [KeyOf(self.oddHashes[(flag, row)]) for row in oddRows]
+            rows = numpy.concatenate((rows, numpy.array(oddRows, dtype=numpy.int64)))
+            keys = numpy.concatenate((keys, numpy.array(oddKeys, dtype=numpy.uint64)))
+
+        return keys, rows
+
+    def PathKeys(self):
+        rows = numpy.arange(self.count, dtype=numpy.int64)
+        keys = numpy.fromiter((KeyOf(self.Path(row)) for row in range(self.count)), dtype=numpy.uint64, count=self.count)
+        return keys, rows
+
+    def CopyRows(self, start):
+        """Rows from start onwards, as a store of their own"""
+        copy = CHashStore(max(self.count - start, 1))
+        copy.Extend(self, start)
+        return copy
+
+    def Extend(self, other, start=0):
+        """Append other's rows from start onwards, stat data and flags included. Returns the first new row"""
+        first = self.count
+
+        for row in range(start, other.count):
+            newRow = self.Append(other[row])
+
+            # Rows given up on stay given up on
+            if not other.IsDeferred(row):
+                self.ClearDeferred(newRow)
+
+            stat = other.Stat(row)
+            if stat is not None:
+                self.SetStat(newRow, stat)
+
+            self.SetSegments(newRow, other.Segments(row))
+            self.SetTiers(newRow, other.Tiers(row))
+
+        return first
+
+    def Compact(self, removedRows):
+        """
+        Drop removedRows. Later rows move down to fill the gaps
+
+        Returns where each old row went, -1 for those dropped, so indices can follow
+        """
+        keep = numpy.ones(self.count, dtype=bool)
+        keep[numpy.fromiter(removedRows, dtype=numpy.int64)] = False
+        newRows = numpy.cumsum(keep) - 1
+
+        pathBlob = bytearray()
+        pathEnds = []
+        for row in numpy.flatnonzero(keep):
+            pathBlob += self.Path(row)
+            pathEnds.append(len(pathBlob))
+
+        for name in ("sizes", "flags", "shortHashes", "longHashes", "extensionIds", "statDevices", "statInodes", "statTimes"):
+            setattr(self, name, getattr(self, name)[:self.count][keep])
+
+        self.pathEnds = numpy.array(pathEnds, dtype=numpy.int64)
+        self.pathBlob = pathBlob
+
+        self.perceptual = {int(newRows[row]): ph for row, ph in self.perceptual.items() if keep[row]}
+        self.segments = {int(newRows[row]): segments for row, segments in self.segments.items() if keep[row]}
+        self.tiers = {int(newRows[row]): tiers for row, tiers in self.tiers.items() if keep[row]}
+        self.oddHashes = {(flag, int(newRows[row])): value for (flag, row), value in self.oddHashes.items() if keep[row]}
+
+        self.count = int(keep.sum())
+        self.capacity = self.count
+
+        newRows[~keep] = -1
+        return newRows
+
+    def Pack(self):
+        """Plain columns, for pickling"""
+        n = self.count
+        return {
+            "Layout": STORE_LAYOUT_VERSION,
+            "Sizes": self.sizes[:n],
+            "Flags": self.flags[:n],
+            "ShortHashes": self.shortHashes[:n],
+            "LongHashes": self.longHashes[:n],
+            "ExtensionIds": self.extensionIds[:n],
+            "Extensions": self.extensions,
+            "PathEnds": self.pathEnds[:n],
+            "PathBlob": bytes(self.pathBlob),
+            "StatDevices": self.statDevices[:n],
+            "StatInodes": self.statInodes[:n],
+            "StatTimes": self.statTimes[:n],
+            "Perceptual": self.perceptual,
+            "Segments": self.segments,
+            "Tiers": self.tiers,
+            "OddHashes": self.oddHashes
+        }
+
+    @classmethod
+    def FromPacked(cls, packed):
+        if packed.get("Layout") != STORE_LAYOUT_VERSION:
+            raise RuntimeError("Hash store layout {} is not supported".format(packed.get("Layout")))
+
+        store = cls(0)
+        store.count = store.capacity = len(packed["Sizes"])
+
+        store.sizes = numpy.array(packed["Sizes"], dtype=numpy.int64)
+        store.flags = numpy.array(packed["Flags"], dtype=numpy.uint8)
+        store.shortHashes = numpy.array(packed["ShortHashes"], dtype=numpy.uint8).reshape(-1, DIGEST_SIZE)
+        store.longHashes = numpy.array(packed["LongHashes"], dtype=numpy.uint8).reshape(-1, DIGEST_SIZE)
+        store.extensionIds = numpy.array(packed["ExtensionIds"], dtype=numpy.int32)
+        store.pathEnds = numpy.array(packed["PathEnds"], dtype=numpy.int64)
+        store.pathBlob = bytearray(packed["PathBlob"])
+        store.statDevices = numpy.array(packed["StatDevices"], dtype=numpy.uint64)
+        store.statInodes = numpy.array(packed["StatInodes"], dtype=numpy.uint64)
+        store.statTimes = numpy.array(packed["StatTimes"], dtype=numpy.int64)
+
+        store.extensions = list(packed["Extensions"])
+        store.extensionLookup = {ext: idx for idx, ext in enumerate(store.extensions)}
+        store.perceptual = dict(packed["Perceptual"])
+        # Added after the layout. Tables from before have none
+        store.segments = dict(packed.get("Segments", {}))
+        store.tiers = dict(packed.get("Tiers", {}))
+        store.oddHashes = dict(packed["OddHashes"])
+
+        return store
+
+    @classmethod
+    def FromEntries(cls, entries):
+        """Build from a list of entry tuples, as older tables store them"""
+        store = cls(max(len(entries), 1))
+
+        for entry in entries:
+            store.Append(entry)
+
+        return store
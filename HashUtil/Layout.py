@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows. Extents fall back to inodes
+    fcntl = None
+
+# Orders files can be read in. Walk leaves them as found
+ORDER_WALK = "walk"
+ORDER_INODE = "inode"
+ORDER_EXTENT = "extent"
+ORDERS = [ORDER_WALK, ORDER_INODE, ORDER_EXTENT]
+
+# Files are put in order this many at a time
+DEFAULT_BATCH_SIZE = 1024
+
+# linux/fiemap.h: _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+# Extents whose physical offset means nothing: not yet allocated, or stored in the inode
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+
+
+def FirstExtent(path):
+    """Physical byte offset of the start of the file on its device, or None where that can't be found"""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return None
+
+    # Room for one extent
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 2 ** 64 - 1, 0, 0, 1, 0)
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    except OSError:
+        # Filesystems without FIEMAP, such as most network ones
+        return None
+    finally:
+        os.close(fd)
+
+    if FIEMAP_HEADER.unpack_from(request, 0)[3] == 0:
+        return None
+
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)
+    if extent[5] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC | FIEMAP_EXTENT_DATA_INLINE):
+        return None
+
+    return extent[1]
+
+def LayoutKey(path, stat, order):
+    """
+    Sort key putting files in the order they lie on disk
+
+    Files are grouped by device. Within one, files with a known extent come first by where
+    they start, then the rest by inode
+    """
+    if stat is None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Whoever reads it reports the error. Last is as good as anywhere
+            return (sys.maxsize, 1, 0)
+
+    if order == ORDER_EXTENT:
+        extent = FirstExtent(path)
+
+        if extent is not None:
+            return (stat.st_dev, 0, extent)
+
+    return (stat.st_dev, 1, stat.st_ino)
+
+def Schedule(files, order):
+    """
+    Indices of files, a list of (path, stat), in the order to read them
+
+    Only the reading is reordered. Whoever hashes them still looks them up in the order given
+    """
+    if order == ORDER_WALK:
+        return list(range(len(files)))
+
+    keys = [LayoutKey(path, stat, order) for path, stat in files]
+    return sorted(range(len(files)), key=lambda i: keys[i])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import mmap
+import time
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+# Files are read this much at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Files at least this large are mapped instead, which saves copying them out of the page cache
+DEFAULT_MMAP_THRESHOLD = 256 * 1024 * 1024
+
+# With read ahead, the OS is asked to start reading this many of the files queued next
+READ_AHEAD_FILES = 4
+
+
+class CThrottle():
+    """Holds every read through it to a number of bytes per second, between all threads"""
+
+    def __init__(self, bytesPerSecond):
+        self.bytesPerSecond = bytesPerSecond
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def Take(self, count):
+        """Account for count bytes just read, waiting for as long as they put the reads ahead"""
+        with self._lock:
+            now = time.monotonic()
+
+            # Idle time isn't saved up for a burst later
+            start = max(self._next, now)
+            self._next = start + count / self.bytesPerSecond
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class CFileReader():
+    """
+    Reads files for hashing without allocating for every read
+
+    Each thread has one buffer, reused for every chunk and block it reads. What comes back
+    is a view into that buffer (or into a mapping of the file), only good until the next
+    read on the same thread
+
+    ReadAhead is the number of threads reading for the others. When set, the next chunk of
+    a file is read on one of them while the last is being hashed, into a second buffer per
+    thread. Otherwise reading and hashing take turns
+
+    DropCache has the OS drop what's been read from its cache once it's hashed, so a big scan
+    doesn't push out everything else. Throttle, a CThrottle, caps the rate of reading
+    """
+
+    def __init__(self, chunkSize=DEFAULT_CHUNK_SIZE, mmapThreshold=DEFAULT_MMAP_THRESHOLD, readAhead=0):
+        self.chunkSize = chunkSize
+        self.mmapThreshold = mmapThreshold
+        self.readAhead = readAhead
+        self.dropCache = False
+        self.throttle = None
+        self._local = threading.local()
+        self._pool = None
+        self._poolLock = threading.Lock()
+
+        # Stands in for os.preadv where there isn't one
+        self._seekLock = threading.Lock()
+
+    def _Buffer(self, size, slot=0):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = [None, None]
+
+        buffer = buffers[slot]
+
+        if buffer is None or len(buffer) < size:
+            # Drop the old one first, so both are never held at once
+            buffers[slot] = None
+            buffer = bytearray(size)
+            buffers[slot] = buffer
+
+        return memoryview(buffer)[:size]
+
+    def _Pool(self):
+        # Shared by every thread reading through this reader
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.readAhead)
+            return self._pool
+
+    def _Advise(self, fileObj, offset, size, advice):
+        """posix_fadvise, where there is one. Only a hint, so nothing comes of it failing"""
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        try:
+            os.posix_fadvise(fileObj.fileno(), offset, size, getattr(os, advice))
+        except (OSError, ValueError, OverflowError, io.UnsupportedOperation):
+            pass
+
+    def _Done(self, fileObj, offset, count):
+        """Bookkeeping once count bytes from offset have been read"""
+        if self.throttle is not None:
+            self.throttle.Take(count)
+
+        if self.dropCache:
+            self._Advise(fileObj, offset, count, "POSIX_FADV_DONTNEED")
+
+    def Release(self, fileObj):
+        """Drop a file that's finished with from the cache, if dropping. Catches reads made around the reader"""
+        if self.dropCache:
+            self._Advise(fileObj, 0, 0, "POSIX_FADV_DONTNEED")
+
+    def Hint(self, path):
+        """Have the OS start reading the head of a file that's about to be hashed"""
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.posix_fadvise(fd, 0, self.chunkSize, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _ReadInto(self, fileObj, view):
+        """Fill view from the file, short only at the end of it. Returns the bytes read"""
+        total = 0
+
+        while total < len(view):
+            count = fileObj.readinto(view[total:])
+
+            if not count:
+                break
+
+            total += count
+
+        return total
+
+    def _Map(self, fileObj):
+        """Read only mapping of the whole file, or None where it can't or shouldn't be mapped"""
+        try:
+            fileSize = fileObj.seek(0, io.SEEK_END)
+            fileObj.seek(0)
+
+            # Pages that are mapped can't be dropped from the cache
+            if fileSize < self.mmapThreshold or fileSize == 0 or self.dropCache:
+                return None
+
+            mapping = mmap.mmap(fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            return None
+
+        if hasattr(mapping, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+        return mapping
+
+    def Chunks(self, fileObj, start=0):
+        """Yield the file from start to the end as views, at most chunkSize each"""
+        mapping = self._Map(fileObj)
+
+        if mapping is not None:
+            with mapping:
+                for offset in range(start, len(mapping), self.chunkSize):
+                    chunk = memoryview(mapping)[offset:offset + self.chunkSize]
+
+                    # Fault the next chunk in while this one is hashed
+                    if self.readAhead and offset + self.chunkSize < len(mapping) and hasattr(mmap, "MADV_WILLNEED"):
+                        mapping.madvise(mmap.MADV_WILLNEED, offset + self.chunkSize, min(self.chunkSize, len(mapping) - offset - self.chunkSize))
+
+                    if self.throttle is not None:
+                        self.throttle.Take(len(chunk))
+
+                    try:
+                        yield chunk
+                    finally:
+                        # The mapping won't close while a view of it is alive
+                        chunk.release()
+            return
+
+        yield from self._Stream(fileObj, start, None)
+
+    def _Stream(self, fileObj, offset, end):
+        """Yield views from offset to end, or the end of the file if None, at most chunkSize each"""
+        size = self.chunkSize if end is None else min(self.chunkSize, max(end - offset, 1))
+        self._Advise(fileObj, offset, 0 if end is None else end - offset, "POSIX_FADV_SEQUENTIAL")
+
+        if not self.readAhead:
+            buffer = self._Buffer(size)
+
+            while end is None or offset < end:
+                count = self._ReadAt(fileObj, offset, buffer if end is None else buffer[:min(size, end - offset)])
+
+                if not count:
+                    break
+
+                yield buffer[:count]
+                self._Done(fileObj, offset, count)
+                offset += count
+            return
+
+        pool = self._Pool()
+        buffers = [self._Buffer(size, 0), self._Buffer(size, 1)]
+
+        def Submit(slot, position):
+            if end is not None and position >= end:
+                return None
+
+            return pool.submit(self._ReadAt, fileObj, position, buffers[slot] if end is None else buffers[slot][:min(size, end - position)])
+
+        slot = 0
+        pending = Submit(slot, offset)
+
+        try:
+            while pending is not None:
+                count = pending.result()
+                pending = None
+
+                if not count:
+                    break
+
+                # The next chunk is read while this one is hashed, and the one after is asked for
+                pending = Submit(1 - slot, offset + count)
+                self._Advise(fileObj, offset + count + size, size, "POSIX_FADV_WILLNEED")
+
+                yield buffers[slot][:count]
+                self._Done(fileObj, offset, count)
+                offset += count
+                slot = 1 - slot
+        finally:
+            # Don't let the buffer go while it's still being read into
+            if pending is not None:
+                concurrent.futures.wait([pending])
+
+    def _ReadAt(self, fileObj, offset, view):
+        """Fill view from offset, short only at the end of the file. Returns the bytes read"""
+        try:
+            fd = fileObj.fileno() if hasattr(os, "preadv") else None
+        except (OSError, io.UnsupportedOperation):
+            fd = None
+
+        if fd is None:
+            with self._seekLock:
+                fileObj.seek(offset)
+                return self._ReadInto(fileObj, view)
+
+        total = 0
+
+        while total < len(view):
+            count = os.preadv(fd, [view[total:]], offset + total)
+
+            if not count:
+                break
+
+            total += count
+
+        return total
+
+    def Range(self, fileObj, offset, size):
+        """
+        Yield size bytes from offset (fewer at the end of the file) as views, at most chunkSize each
+
+        Several threads can read ranges of one file at once
+        """
+        return self._Stream(fileObj, offset, offset + size)
+
+    def Block(self, fileObj, offset, size):
+        """View of up to size bytes from offset. A negative offset counts back from the end"""
+        if offset < 0:
+            position = fileObj.seek(offset, io.SEEK_END)
+        else:
+            position = fileObj.seek(offset)
+
+        buffer = self._Buffer(size)
+        count = self._ReadInto(fileObj, buffer)
+
+        # Already copied out, so it can go from the cache straight away
+        self._Done(fileObj, position, count)
+        return buffer[:count]
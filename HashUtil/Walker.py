@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# A folder holding this file is skipped, along with everything below it
+SKIP_FOLDER_MARKER = ".skipfolder"
+
+# With several listing threads, at most this many folders per thread are listed ahead of the walk
+LISTING_LOOKAHEAD = 4
+
+# Files in one folder are stat'ed this many to a task
+STAT_BATCH = 64
+
+
+def GetExtension(filename):
+    return os.fsencode(filename.split(".")[-1].lower())
+
+def _ListDirectory(top, excludeDirs, excludeFileTypes):
+    """
+    (skip, files, children) for one folder, or None if it can't be listed
+
+    Files are DirEntries, split from folders the way os.walk splits them. Children are the
+    names of the folders to go into, which leaves out links to folders as os.walk does
+    """
+    dirs = []
+    files = []
+
+    try:
+        with os.scandir(top) as entries:
+            for entry in entries:
+                try:
+                    isDir = entry.is_dir()
+                except OSError:
+                    isDir = False
+
+                (dirs if isDir else files).append(entry)
+    except OSError:
+        # os.walk passes over these too
+        return None
+
+    files = [x for x in files if GetExtension(x.name) not in excludeFileTypes]
+
+    if any(x.name == SKIP_FOLDER_MARKER for x in files):
+        return True, [], []
+
+    return False, files, [x.name for x in dirs if x.name not in excludeDirs and not x.is_symlink()]
+
+def _StatEntries(entries):
+    """Stat of each entry, None where it can't be stat'ed"""
+    stats = []
+
+    for entry in entries:
+        try:
+            stats.append(entry.stat())
+        except OSError:
+            stats.append(None)
+
+    return stats
+
+
+class CWalkPending():
+    """A folder the walk has yet to reach, and its listing if that's already been asked for"""
+
+    def __init__(self, top, relDir):
+        self.top = top
+        self.relDir = relDir
+        self.listing = None
+
+
+def _Fill(pool, pending, ahead, limit, excludeDirs, excludeFileTypes):
+    """
+    Start listing the folders the walk reaches next, until limit are listed ahead of it
+
+    Returns how many are now listed ahead
+    """
+    for folder in reversed(pending[-limit:]):
+        if ahead >= limit:
+            break
+
+        if folder.listing is None:
+            folder.listing = pool.submit(_ListDirectory, folder.top, excludeDirs, excludeFileTypes)
+            ahead += 1
+
+    return ahead
+
+def Walk(path, excludeDirs=(), excludeFileTypes=(), jobs=1):
+    """
+    Yield (root, name, relPath, extension, stat) for each file below path, in os.walk order
+
+    Built on os.scandir, so each file costs one stat and no path joins beyond root. relPath is
+    relative to path, as bytes. Stat is None where the file can't be stat'ed, so whoever opens
+    it reports the error. Folders skipped for a .skipfolder come through as (root, None, None,
+    None, None), in order, and aren't entered
+
+    Jobs above 1 list folders and stat files on that many threads, ahead of what's been
+    yielded. That hides the round trips of network filesystems. The order is unchanged
+    """
+    pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    limit = jobs * LISTING_LOOKAHEAD
+    ahead = 0
+
+    # Depth first, children in listing order, as os.walk goes
+    pending = [CWalkPending(path, b"")]
+    batches = []
+
+    try:
+        while pending:
+            folder = pending.pop()
+
+            if pool is None:
+                listing = _ListDirectory(folder.top, excludeDirs, excludeFileTypes)
+            else:
+                if folder.listing is None:
+                    folder.listing = pool.submit(_ListDirectory, folder.top, excludeDirs, excludeFileTypes)
+                else:
+                    ahead -= 1
+                listing = folder.listing.result()
+
+            if listing is None:
+                continue
+
+            skip, files, children = listing
+            if skip:
+                yield (folder.top, None, None, None, None)
+                continue
+
+            if pool is None:
+                batches = [_StatEntries(files)]
+            else:
+                batches = [pool.submit(_StatEntries, files[i:i + STAT_BATCH]) for i in range(0, len(files), STAT_BATCH)]
+
+            for name in reversed(children):
+                pending.append(CWalkPending(os.path.join(folder.top, name), folder.relDir + os.fsencode(name) + os.fsencode(os.sep)))
+
+            # Below here is listed while this folder's files are worked on
+            if pool is not None:
+                ahead = _Fill(pool, pending, ahead, limit, excludeDirs, excludeFileTypes)
+
+            entries = iter(files)
+            for batch in batches:
+                for stat in (batch if pool is None else batch.result()):
+                    entry = next(entries)
+                    yield (folder.top, entry.name, folder.relDir + os.fsencode(entry.name), GetExtension(entry.name), stat)
+    finally:
+        if pool is not None:
+            # Listings and stats nobody will wait for. shutdown's cancel_futures needs 3.9
+            for folder in pending:
+                if folder.listing is not None:
+                    folder.listing.cancel()
+
+            for batch in batches:
+                batch.cancel()
+
+            pool.shutdown(wait=False)
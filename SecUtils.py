@@ -152,10 +152,7 @@ if __name__ == "__main__":
 
 
 
-    rawFileSizeList = numpy.zeros(len(hashlist.hashList))
-    
-    for i in range(len(hashlist.hashList)):
-        rawFileSizeList[i] = hashlist.hashList[i][0]
+    rawFileSizeList = hashlist.hashList.Sizes().astype(numpy.float64)
 
 
     #print(GetTypes())
@@ -7,6 +7,7 @@ import argparse
 import platform
 from HashUtil import HashList
 from HashUtil import Utils
+from HashUtil import Walker
 
 def MoveFileToQuarantine(root, fl, args):
     Utils.Quarantine(root, fl, args, "../.!Quarantine")
@@ -60,9 +61,6 @@ def IsDriveSafe(a,b):
 
     return True
 
-def GetExtension(filename: str):
-    return filename.split(".")[-1].lower().encode()
-
 excludeDirs = [".git"]
 excludeFileTypes = [b"gitignore"]
 
@@ -75,6 +73,7 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--raw", action="store_true", help='Prevent hashing the contents of files; instead hash the container')
     parser.add_argument("--silent", action="store_true", help='Silence output')
     parser.add_argument('-t', '--hashtable', nargs=1, type=str, help='Location of hashtable')
+    parser.add_argument('--walk-jobs', type=int, default=1, help='Threads listing folders and stat\'ing files ahead of the hashing. Speeds up network filesystems')
     parser.add_argument("path", metavar="path", type=str)
 
 
@@ -100,36 +99,27 @@ if __name__ == "__main__":
 
     hashlist = HashList.CHashList(encodedHashtable)
 
-    for r, d, p in os.walk(args.path):
-        d[:] = [x for x in d if x not in excludeDirs]
-        p[:] = [x for x in p if GetExtension(x) not in excludeFileTypes]
-
-        if ".skipfolder" in p:
-            d[:] = []#[x for x in d]
+    for r, fi, relp, ext, stat in Walker.Walk(args.path, excludeDirs, excludeFileTypes, args.walk_jobs):
+        if fi is None:
             print("[IGNORE] Skipping Below {}".format(r))
             continue
 
-        for fi in p:
-            # Let's catagorise these
-            f = fi.split(".")
-            path = os.path.join(r, fi)
-            relp = os.path.relpath(path, os.path.abspath(args.path)).encode()
-            ext = f[len(f) - 1].lower().encode()
-
-
-            try:
-                if not hashlist.IsElementKnown(args.path.encode(), relp, ext, allowLongHashes=args.long_hash, silent=args.silent, useRawHashes=args.raw):
-                    hashlist.AddElement(args.path.encode(), relp, ext, silent=args.silent, useLongHash=args.long_hash, useRawHashes=args.raw, disableCheckpoint=True)
-                    if not args.silent:
-                        print("[CLEAR] File: {}".format(relp))#.decode()))
-                    pass
-                else:
-                    #print("Wanting to move {}".format(relp))
-                    if args.allow_quarantine:
-                        MoveFileToQuarantine(args.path.encode(), (relp, ext), args)  
-            except KeyboardInterrupt as kbi:
-                raise kbi
-            except Exception as e:
-                print("Error on file {}. Reason: {}".format(relp, e), file=sys.stderr)
-                #raise e
-                continue
\ No newline at end of file
+        try:
+            # The walk's stat is reused rather than taken again
+            with hashlist.HashElement(pathAsBytes, relp, ext, args.raw, stat=stat) as element:
+                result = hashlist.CheckAndAddElement(pathAsBytes, relp, ext, allowLongHashes=args.long_hash, silent=args.silent, useRawHashes=args.raw, useLongHash=args.long_hash, disableCheckpoint=True, element=element)
+
+            if result.status == HashList.RESULT_ADDED:
+                if not args.silent:
+                    print("[CLEAR] File: {}".format(relp))#.decode()))
+                pass
+            else:
+                #print("Wanting to move {}".format(relp))
+                if args.allow_quarantine:
+                    MoveFileToQuarantine(args.path.encode(), (relp, ext), args)  
+        except KeyboardInterrupt as kbi:
+            raise kbi
+        except Exception as e:
+            print("Error on file {}. Reason: {}".format(relp, e), file=sys.stderr)
+            #raise e
+            continue
\ No newline at end of file
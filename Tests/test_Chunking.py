@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import numpy
+from HashUtil import Chunking
+
+AVERAGE_SIZE = 4 * 1024
+
+
+def _Data(seed, size):
+    return numpy.random.default_rng(seed).integers(0, 256, size, dtype=numpy.uint8).tobytes()
+
+def _Chunk(tmp_path, data, blockSize=Chunking.DEFAULT_BLOCK_SIZE):
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+
+    with open(path, "rb") as f:
+        return Chunking.CChunker(AVERAGE_SIZE, blockSize).ChunkFile(f)
+
+def test_ChunkSizes(tmp_path):
+    data = _Data(0, 512 * 1024)
+    keys, sizes = _Chunk(tmp_path, data)
+
+    assert(int(sizes.sum()) == len(data))
+    assert(sizes[:-1].min() >= AVERAGE_SIZE // 4)
+    assert(sizes.max() <= AVERAGE_SIZE * 8)
+    assert(len(keys) > len(data) // (AVERAGE_SIZE * 4))
+
+def test_BlockSizeDoesNotMoveBoundaries(tmp_path):
+    data = _Data(1, 512 * 1024)
+
+    # Blocks smaller than a chunk, so boundaries fall across block edges
+    keys, sizes = _Chunk(tmp_path, data)
+    smallKeys, smallSizes = _Chunk(tmp_path, data, 3000)
+
+    assert(keys.tolist() == smallKeys.tolist())
+    assert(sizes.tolist() == smallSizes.tolist())
+
+def test_InsertionOnlyChangesNearbyChunks(tmp_path):
+    data = _Data(2, 512 * 1024)
+    middle = len(data) // 2
+    inserted = data[:middle] + b"inserted" * 16 + data[middle:]
+
+    keys, _ = _Chunk(tmp_path, data)
+    newKeys, newSizes = _Chunk(tmp_path, inserted)
+
+    # Everything before and after the chunks around the insertion is found again
+    changed = numpy.flatnonzero(~numpy.isin(newKeys, keys))
+    assert(0 < len(changed) <= 3)
+    assert(int(newSizes[changed].sum()) < AVERAGE_SIZE * 16)
+    assert(numpy.isin(keys, newKeys).sum() >= len(keys) - 3)
+
+def test_SharedBytes():
+    index = Chunking.CChunkIndex()
+    index.Add("a", numpy.array([1, 2, 3], dtype=numpy.uint64), numpy.array([10, 20, 30]))
+    index.Add("b", numpy.array([2, 3, 3, 4], dtype=numpy.uint64), numpy.array([20, 30, 30, 40]))
+    index.Add("c", numpy.array([3, 5], dtype=numpy.uint64), numpy.array([30, 50]))
+
+    # Chunk 3 counts once for b, however often it appears there
+    assert(index.SharedBytes() == ({(0, 1): 50, (0, 2): 30, (1, 2): 30}, 0))
+
+    # With at most two holders, chunk 3 is left out
+    assert(index.SharedBytes(2) == ({(0, 1): 20}, 1))
+
+    assert(index.TotalBytes() == 260)
+    assert(index.UniqueBytes() == 150)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import numpy
+import pytest
+from PIL import Image
+from PIL import PngImagePlugin
+from HashUtil import Containers
+from HashUtil import Extensions
+from HashUtil import HashList
+
+
+def _Picture(seed):
+    rng = numpy.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=numpy.uint8))
+
+def _Png(image, text=None, level=6):
+    info = None
+    if text is not None:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", text)
+
+    out = io.BytesIO()
+    image.save(out, "PNG", pnginfo=info, compress_level=level)
+    return out.getvalue()
+
+def _Jpeg(image, make=None):
+    exif = Image.Exif()
+    if make is not None:
+        exif[0x010F] = make
+
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90, exif=exif.tobytes())
+    return out.getvalue()
+
+def _WithJpegComment(data, comment):
+    """data with a COM segment straight after SOI"""
+    return data[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + data[2:]
+
+def _Payload(data):
+    return b"".join(bytes(x) for x in Containers.PayloadOf(data))
+
+def _Hashes(tmp_path, data, extension, payload=True):
+    name = b"image." + extension
+    with open(os.path.join(os.fsencode(tmp_path), name), "wb") as f:
+        f.write(data)
+
+    table = HashList.CHashList(None, [Extensions.EXT_ContainerPayloadHash] if payload else None, inMemory=True)
+    with table.HashElement(os.fsencode(tmp_path), name, extension) as element:
+        return element.ShortHash(), element.LongHash()
+
+def test_PngMetadataIsLeftOut(tmp_path):
+    plain = _Png(_Picture(0))
+    tagged = _Png(_Picture(0), "Taken on a Tuesday")
+
+    assert(plain != tagged)
+    assert(_Payload(plain) == _Payload(tagged))
+    assert(_Payload(plain) != _Payload(_Png(_Picture(1))))
+
+    assert(_Hashes(tmp_path, plain, b"png") == _Hashes(tmp_path, tagged, b"png"))
+
+def test_JpegMetadataIsLeftOut(tmp_path):
+    plain = _Jpeg(_Picture(0))
+    tagged = _WithJpegComment(_Jpeg(_Picture(0), "Some Camera"), b"Edited")
+
+    assert(plain != tagged)
+    assert(_Payload(plain) == _Payload(tagged))
+    assert(_Payload(plain) != _Payload(_Jpeg(_Picture(1))))
+
+    assert(_Hashes(tmp_path, plain, b"jpg") == _Hashes(tmp_path, tagged, b"jpg"))
+
+def test_PayloadChangesWithThePixels(tmp_path):
+    assert(_Hashes(tmp_path, _Png(_Picture(0)), b"png") != _Hashes(tmp_path, _Png(_Picture(1)), b"png"))
+    assert(_Hashes(tmp_path, _Jpeg(_Picture(0)), b"jpg") != _Hashes(tmp_path, _Jpeg(_Picture(1)), b"jpg"))
+
+def test_PayloadIsHashedRatherThanPixels(tmp_path):
+    # Same pixels, compressed differently. Only the pixel hashes agree
+    fast = _Png(_Picture(0), level=1)
+    small = _Png(_Picture(0), level=9)
+
+    assert(_Hashes(tmp_path, fast, b"png", False) == _Hashes(tmp_path, small, b"png", False))
+    assert(_Hashes(tmp_path, fast, b"png") != _Hashes(tmp_path, small, b"png"))
+
+def test_BrokenContainers():
+    for data in [b"GIF89a", b"\xff\xd8\x00", Containers.PNG_SIGNATURE + b"\x00\x00\x00\x00IHDR"]:
+        with pytest.raises(ValueError):
+            Containers.PayloadOf(data)
+
+def test_Slice():
+    pieces = [b"abc", memoryview(b"defg"), b"h"]
+
+    assert(b"".join(Containers.Slice(pieces, 0, 8)) == b"abcdefgh")
+    assert(b"".join(Containers.Slice(pieces, 2, 5)) == b"cde")
+    assert(b"".join(Containers.Slice(pieces, 7, 8)) == b"h")
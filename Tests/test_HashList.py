@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import numpy
+import pytest
+from PIL import Image
+from HashUtil import HashList
+from HashUtil import Reader
+
+
+def _WriteFile(root, name, data):
+    with open(os.path.join(root, name), "wb") as f:
+        f.write(data)
+
+def _Digest(table, data):
+    digest = table._NewDigest()
+    digest.update(data)
+    return digest.finalize()
+
+def test_LadderMatchesLongHash(tmp_path, monkeypatch):
+    # Small tiers, so one small file has both
+    monkeypatch.setattr(HashList, "TIER_SIZES", [1000, 5000])
+
+    root = os.fsencode(tmp_path)
+    data = os.urandom(12345)
+    _WriteFile(root, b"data.bin", data)
+
+    table = HashList.CHashList(None, None, inMemory=True)
+    table.reader = Reader.CFileReader(chunkSize=4096, mmapThreshold=1)
+
+    maps = []
+    realMap = table.reader._Map
+    monkeypatch.setattr(table.reader, "_Map", lambda fileObj: maps.append(fileObj) or realMap(fileObj))
+
+    with table.HashElement(root, b"data.bin", b"bin") as element:
+        # A tier at a time, then the rest
+        assert(element.TierHash(0) == _Digest(table, data[:1000]))
+        assert(element.TierHash(1) == _Digest(table, data[:5000]))
+        longHash = element.LongHash()
+        tiers = element.Tiers()
+
+    with open(os.path.join(root, b"data.bin"), "rb") as f:
+        assert(longHash == table._GetLongHash(f))
+
+    assert(longHash == _Digest(table, data))
+    assert(tiers == _Digest(table, data[:1000]) + _Digest(table, data[:5000]))
+
+    # Past the last tier, large files are mapped as _GetLongHash maps them
+    assert(len(maps) == 2)
+
+def test_LadderWithoutTiers(tmp_path, monkeypatch):
+    monkeypatch.setattr(HashList, "TIER_SIZES", [1000, 5000])
+
+    root = os.fsencode(tmp_path)
+    data = os.urandom(600)
+    _WriteFile(root, b"small.bin", data)
+
+    table = HashList.CHashList(None, None, inMemory=True)
+    with table.HashElement(root, b"small.bin", b"bin") as element:
+        assert(element.TierHash(0) is None)
+        assert(element.LongHash() == _Digest(table, data))
+        assert(element.Tiers() is None)
+
+def _Scan(table, root, names, incremental=False):
+    """Add each file the way GenerateHashList does. Returns the ones that were hashed"""
+    hashed = []
+
+    for name in names:
+        stat = os.stat(os.path.join(root, name))
+        if incremental and table.IsElementUnchanged(name, stat):
+            continue
+
+        if incremental:
+            table.ForgetElement(name)
+
+        with table.HashElement(root, name, b"bin", stat=stat) as element:
+            table.CheckAndAddElement(root, name, b"bin", allowLongHashes=True, silent=True, disableCheckpoint=True, element=element)
+        hashed.append(name)
+
+    return hashed
+
+def _Rewrite(root, name, data, mtime):
+    _WriteFile(root, name, data)
+    os.utime(os.path.join(root, name), ns=(mtime, mtime))
+
+def test_IncrementalSkipsUnchangedFiles(tmp_path):
+    root = os.fsencode(tmp_path / "tree")
+    os.makedirs(root)
+    path = os.fsencode(tmp_path / "table.ht")
+
+    content = os.urandom(1000)
+    _WriteFile(root, b"a.bin", content)
+    _WriteFile(root, b"b.bin", content)
+    _WriteFile(root, b"c.bin", os.urandom(2000))
+    _WriteFile(root, b"empty.bin", b"")
+    names = [b"a.bin", b"b.bin", b"c.bin", b"empty.bin"]
+
+    table = HashList.CHashList(path)
+    _Scan(table, root, names)
+
+    # A full rescan matches every file to its own entry, which needs no record
+    _Scan(table, root, names)
+    assert(sorted(table.resolvedPaths) == [b"b.bin", b"empty.bin"])
+    table.Write()
+
+    table = HashList.CHashList(path)
+    assert(_Scan(table, root, names, True) == [])
+
+    # Modifying the original brings its duplicate back too
+    _Rewrite(root, b"a.bin", os.urandom(1000), 10 ** 18)
+    _Rewrite(root, b"c.bin", os.urandom(2000), 10 ** 18)
+    assert(_Scan(table, root, names, True) == [b"a.bin", b"b.bin", b"c.bin"])
+    assert(_Scan(table, root, names, True) == [])
+
+def _Decoded(mode, size=(37, 53)):
+    rng = numpy.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (size[1], size[0], 4), dtype=numpy.uint8), "RGBA").convert(mode)
+
+    out = io.BytesIO()
+    image.save(out, "TIFF" if mode == "CMYK" else "PNG")
+    out.seek(0)
+    return HashList.CDecodedImage(out)
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "P", "RGBA", "CMYK", "LA"])
+def test_PixelStripsMatchWholeArray(mode):
+    table = HashList.CHashList(None, None, inMemory=True)
+
+    # A few rows to a strip, so the strips don't line up with the limit
+    table.pixelStripBytes = 3 * 37 * 4
+
+    for limit in [None, 1, 10, 53, 100]:
+        decoded = _Decoded(mode)
+        pixels = numpy.array(decoded.Image())
+
+        assert(table._PILHash(decoded, limit) == table._GetHash(pixels[0:limit]))
+
+def test_DecodeLimitIsOptIn():
+    table = HashList.CHashList(None, None, inMemory=True)
+    assert(table.maxDecodedBytes is None)
+
+    # 200x100 RGB is 60000 bytes decoded
+    _Decoded("RGB", (200, 100)).Image()
+
+    decoded = _Decoded("RGB", (200, 100))
+    decoded.maxBytes = 50000
+    with pytest.raises(HashList.CImageTooLargeError):
+        decoded.Image()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import numpy
+from HashUtil import HashStore
+
+
+def test_KeyIndexFindsBuiltAndAddedRows():
+    index = HashStore.CKeyIndex()
+    index.Build([5, 3, 5, 9], [0, 1, 2, 3])
+
+    assert(index.Find(5) == [0, 2])
+    assert(index.Find(3) == [1])
+    assert(index.Find(4) == [])
+
+    # Waits in recent until there are enough to merge
+    index.Add(3, 4)
+    index.Add(7, 5)
+    assert(index.recent)
+    assert(index.Find(3) == [1, 4])
+    assert(7 in index and 4 not in index)
+    assert(len(index) == 6)
+
+def test_KeyIndexMergeKeepsRowOrder():
+    index = HashStore.CKeyIndex()
+    index.MERGE_MINIMUM = 2
+
+    for row in range(10):
+        index.Add(row % 3, row)
+
+    assert(len(index.recent) < 3)
+    assert(index.Find(0) == [0, 3, 6, 9])
+    assert(index.Find(1) == [1, 4, 7])
+    assert(index.Find(2) == [2, 5, 8])
+
+def test_KeyIndexRemapFollowsCompaction():
+    index = HashStore.CKeyIndex()
+    index.Build([1, 2, 1, 3], [0, 1, 2, 3])
+    index.Add(2, 4)
+
+    # Rows 1 and 2 removed, everything after moves down
+    index.Remap(numpy.array([0, -1, -1, 1, 2]))
+
+    assert(index.Find(1) == [0])
+    assert(index.Find(2) == [2])
+    assert(index.Find(3) == [1])
+    assert(len(index) == 3)
+
+def test_KeyIndexPackRoundTrip():
+    index = HashStore.CKeyIndex()
+    index.Build([4, 8], [0, 1])
+    index.Add(4, 2)
+
+    restored = HashStore.CKeyIndex()
+    assert(restored.Unpack(index.Pack()))
+    assert(restored.Find(4) == [0, 2])
+    assert(restored.Find(8) == [1])
+
+def test_KeyOfDigestsAndPaths():
+    digest = bytes(range(HashStore.DIGEST_SIZE))
+
+    assert(HashStore.KeyOf(digest) == int.from_bytes(digest[:8], "little"))
+    assert(HashStore.KeyOf("a/b") == HashStore.KeyOf(b"a/b"))
+    assert(HashStore.KeyOf(b"a/b") != HashStore.KeyOf(b"a/c"))
+
+
+def _Flip(rng, value, bits):
+    """value with bits random bits flipped"""
+    flipped = numpy.frombuffer(value, dtype=numpy.uint8).copy()
+    for bit in rng.choice(len(value) * 8, bits, replace=False):
+        flipped[bit // 8] ^= 1 << (bit % 8)
+    return flipped.tobytes()
+
+def _NearbyHashes(rng, count, hashBytes):
+    """Hashes in small clusters, so plenty fall within the radius of each other"""
+    hashes = []
+    while len(hashes) < count:
+        centre = rng.integers(0, 256, hashBytes, dtype=numpy.uint8).tobytes()
+        hashes.extend(_Flip(rng, centre, int(rng.integers(0, 16))) for _ in range(8))
+    return hashes[:count]
+
+def _BruteForce(hashes, rows, key, radius):
+    distances = HashStore.HammingDistances(numpy.frombuffer(b"".join(hashes), dtype=numpy.uint8).reshape(len(hashes), -1), numpy.frombuffer(key, dtype=numpy.uint8)[None, :])[:, 0]
+    return sorted(row for row, distance in zip(rows, distances) if distance <= radius)
+
+def test_HammingDistances():
+    a = numpy.array([[0x00, 0xFF], [0x0F, 0x00]], dtype=numpy.uint8)
+    b = numpy.array([[0x00, 0x00], [0xFF, 0xFF], [0x01, 0x80]], dtype=numpy.uint8)
+
+    assert(HashStore.HammingDistances(a, b).tolist() == [[8, 8, 8], [4, 12, 4]])
+
+def test_HammingIndexMatchesBruteForce():
+    rng = numpy.random.default_rng(1)
+    hashBytes = 8
+    radius = 10
+
+    hashes = _NearbyHashes(rng, 600, hashBytes)
+    rows = list(range(len(hashes)))
+
+    index = HashStore.CHammingIndex(hashBytes, radius)
+    index.Build(hashes[:400], rows[:400])
+
+    # The rest stay unsorted, and are scanned directly
+    for key, row in zip(hashes[400:], rows[400:]):
+        index.Add(key, row)
+
+    for key in hashes[::7] + [_Flip(rng, x, radius) for x in hashes[::31]]:
+        assert(index.Find(key) == _BruteForce(hashes, rows, key, radius))
+
+def test_HammingIndexOtherHashes():
+    index = HashStore.CHammingIndex(8, 4)
+    index.Build([bytes(8), b"short", None], [0, 1, 2])
+
+    # Hashes that can't be chunked always come back, and can't be looked up by
+    assert(index.Find(bytes(8)) == [0, 1, 2])
+    assert(index.Find(bytes([0xFF] * 8)) == [1, 2])
+    assert(index.Find(None) == [0, 1, 2])
+
+def test_HammingIndexRemapAndPack():
+    rng = numpy.random.default_rng(2)
+    hashBytes = 8
+    radius = 8
+
+    hashes = _NearbyHashes(rng, 200, hashBytes)
+    index = HashStore.CHammingIndex(hashBytes, radius)
+    index.Build(hashes, range(len(hashes)))
+
+    # Drop every third row
+    newRows = numpy.full(len(hashes), -1)
+    kept = [x for x in range(len(hashes)) if x % 3]
+    newRows[kept] = numpy.arange(len(kept))
+    index.Remap(newRows)
+
+    keptHashes = [hashes[x] for x in kept]
+    keptRows = list(range(len(kept)))
+
+    restored = HashStore.CHammingIndex(hashBytes, radius)
+    assert(restored.Unpack(index.Pack()))
+    assert(not HashStore.CHammingIndex(hashBytes, radius + 1).Unpack(index.Pack()))
+
+    for key in hashes[::5]:
+        expected = _BruteForce(keptHashes, keptRows, key, radius)
+        assert(index.Find(key) == expected)
+        assert(restored.Find(key) == expected)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+from HashUtil import HashList
+
+
+def _MakeTree(root, count):
+    names = []
+    for i in range(count):
+        name = "file{}.bin".format(i).encode()
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(os.urandom(100 + i))
+        names.append(name)
+    return names
+
+def _Add(table, root, names):
+    for name in names:
+        table.CheckAndAddElement(root, name, b"bin", allowLongHashes=True, silent=True, disableCheckpoint=True)
+
+def _Rows(table):
+    return [entry for idx, entry in enumerate(table.hashList) if idx not in table.removedIndices]
+
+def _Setup(tmp_path):
+    root = os.fsencode(tmp_path / "tree")
+    os.makedirs(root)
+    return root, os.fsencode(tmp_path / "table.ht"), _MakeTree(root, 12)
+
+def test_CheckpointsReplay(tmp_path):
+    root, path, names = _Setup(tmp_path)
+
+    table = HashList.CHashList(path)
+    with open(path, "rb") as f:
+        written = f.read()
+
+    _Add(table, root, names[:4])
+    table.Checkpoint()
+    _Add(table, root, names[4:8])
+    table.ForgetElement(names[1])
+    table.Checkpoint()
+
+    # Only the journal has been written to
+    with open(path, "rb") as f:
+        assert(f.read() == written)
+    assert(os.path.exists(path + b".journal"))
+
+    replayed = HashList.CHashList(path)
+    assert(_Rows(replayed) == _Rows(table))
+
+    # Writing folds the journal into the table
+    replayed.Write()
+    assert(not os.path.exists(path + b".journal"))
+    assert(_Rows(HashList.CHashList(path)) == _Rows(table))
+
+def test_TornLastRecordIsIgnored(tmp_path, capsys):
+    root, path, names = _Setup(tmp_path)
+
+    table = HashList.CHashList(path)
+    _Add(table, root, names[:4])
+    table.Write()
+
+    _Add(table, root, names[4:6])
+    table.Checkpoint()
+    expected = _Rows(table)
+
+    _Add(table, root, names[6:8])
+    table.Checkpoint()
+
+    # As if we crashed part way through the second checkpoint
+    with open(path + b".journal", "rb+") as f:
+        f.truncate(os.path.getsize(path + b".journal") - 5)
+
+    replayed = HashList.CHashList(path)
+    assert(_Rows(replayed) == expected)
+    assert("ends in a partial checkpoint" in capsys.readouterr().out)
+
+    # The next checkpoint replaces the torn record
+    _Add(replayed, root, names[8:9])
+    replayed.Checkpoint()
+    assert(_Rows(HashList.CHashList(path)) == _Rows(replayed))
+
+def test_JournalOfAnotherSnapshotIsIgnored(tmp_path, capsys):
+    root, path, names = _Setup(tmp_path)
+
+    table = HashList.CHashList(path)
+    _Add(table, root, names[:4])
+    table.Write()
+
+    _Add(table, root, names[4:6])
+    table.Checkpoint()
+
+    with open(path + b".journal", "rb") as f:
+        journal = f.read()
+
+    # A full write makes a new snapshot. Put the old journal back beside it
+    table.ForgetElement(names[0])
+    table.Write()
+    expected = _Rows(table)
+
+    with open(path + b".journal", "wb") as f:
+        f.write(journal)
+
+    replayed = HashList.CHashList(path)
+    assert(_Rows(replayed) == expected)
+    assert("does not belong to this table" in capsys.readouterr().out)
+
+def test_ReplayedRemovalsAreGone(tmp_path):
+    root, path, names = _Setup(tmp_path)
+
+    table = HashList.CHashList(path)
+    _Add(table, root, names[:6])
+    table.Write()
+
+    table.ForgetElement(names[2])
+    _Add(table, root, names[6:8])
+    table.Checkpoint()
+
+    # Iterating the store directly, as CompareTables and the export do, skips what was forgotten
+    replayed = HashList.CHashList(path)
+    entries = list(replayed.hashList)
+    assert(entries == _Rows(table))
+    assert(names[2] not in [nm[0] for sz, shs, lhs, nm, ph in entries])
+
+    # Rows moved, so the journal can't be added to. The next checkpoint writes the table
+    replayed.Checkpoint()
+    assert(not os.path.exists(path + b".journal"))
+    assert(list(HashList.CHashList(path).hashList) == entries)